@@ -1,10 +1,32 @@
 import streamlit as st
-import google.generativeai as genai
+from google import genai
+from google.genai import types as genai_types
 import textwrap
 import datetime
 import os
 import time
 import uuid
+import sys
+import json
+import heapq
+import itertools
+import html
+import re
+import math
+import random
+import types
+import hashlib
+import sqlite3
+import threading
+import functools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import redis  # ใช้เฉพาะเมื่อ STATE_BACKEND=redis
+except ImportError:
+    redis = None
 
 # --- ตั้งค่า Page Configuration ---
 st.set_page_config(
@@ -14,93 +36,1167 @@ st.set_page_config(
     initial_sidebar_state="collapsed",
 )
 
-# --- File-based persistence สำหรับ Visitor Count และ Active Users ---
-COUNTER_FILE = "visitor_count.txt"
-ACTIVE_USERS_FILE = "active_users.txt"
+# --- Instrumentation: จับเวลาแต่ละขั้นตอน เก็บตัวอย่างล่าสุดไว้ในหน่วยความจำเพื่อดู percentile ---
+METRICS_WINDOW = 1000  # จำนวนตัวอย่างล่าสุดที่เก็บต่อ series
+METRICS_PREFIX = "smart_cooking"
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+class Metrics:
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}  # (ชื่อ, labels) -> deque ของค่าล่าสุด
+        self.totals = {}  # (ชื่อ, labels) -> [จำนวนครั้ง, ผลรวม] ตั้งแต่เริ่ม process
+        self.counters = {}
+
+    def observe(self, name, value, **labels):
+        series = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if series not in self.samples:
+                self.samples[series] = deque(maxlen=self.window)
+                self.totals[series] = [0, 0.0]
+            self.samples[series].append(value)
+            self.totals[series][0] += 1
+            self.totals[series][1] += value
+
+    def incr(self, name, amount=1, **labels):
+        series = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[series] = self.counters.get(series, 0) + amount
+
+    @contextmanager
+    def span(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def _snapshot(self):
+        with self.lock:
+            return sorted((name, labels, sorted(values), *self.totals[(name, labels)])
+                          for (name, labels), values in self.samples.items())
+
+    def summary(self):
+        return [{"metric": name, "labels": ",".join(f"{k}={v}" for k, v in labels), "count": count,
+                 "p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99),
+                 "max": values[-1], "mean": total / count}
+                for name, labels, values, count, total in self._snapshot()]
+
+    def to_prometheus(self):
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        def format_labels(labels, **extra):
+            pairs = list(labels) + list(extra.items())
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+        lines = []
+        family = None
+        # snapshot เรียงตามชื่อ ทุก series ของ metric เดียวกันจึงอยู่ติดกัน และมีบรรทัด TYPE ได้ครั้งเดียวต่อ family
+        for name, labels, values, count, total in self._snapshot():
+            metric = f"{METRICS_PREFIX}_{name}"
+            if metric != family:
+                lines.append(f"# TYPE {metric} summary")
+                family = metric
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f"{metric}{format_labels(labels, quantile=q)} {percentile(values, q):.6f}")
+            lines.append(f"{metric}_count{format_labels(labels)} {count}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {total:.6f}")
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for (name, labels), value in counters:
+            metric = f"{METRICS_PREFIX}_{name}_total"
+            if metric != family:
+                lines.append(f"# TYPE {metric} counter")
+                family = metric
+            lines.append(f"{metric}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_jsonl(self):
+        now = time.time()
+        with self.lock:
+            counters = sorted(self.counters.items())
+        records = [dict(row, type="latency", timestamp=now) for row in self.summary()]
+        records += [{"type": "counter", "metric": name, "labels": ",".join(f"{k}={v}" for k, v in labels),
+                     "value": value, "timestamp": now} for (name, labels), value in counters]
+        return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+@st.cache_resource
+def get_metrics():
+    return Metrics(METRICS_WINDOW)
+
+def span(name, **labels):
+    return get_metrics().span(name, **labels)
+
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span("stage_seconds", stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- Shared state: ตัวนับ, Active Users และสถานะโควต้าของ key ที่ทุก replica ใช้ร่วมกัน (SQLite WAL, Redis หรือหน่วยความจำ) ---
+# "sqlite" ใช้ร่วมกันได้ระหว่าง process บนเครื่องเดียวกัน, "redis" ใช้ร่วมกันระหว่างหลายเครื่อง, "memory" ใช้ภายใน process เดียว
+STATE_BACKEND = os.environ.get("STATE_BACKEND", os.environ.get("PRESENCE_BACKEND", "sqlite"))
+STATE_DB_FILE = "presence.db"
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")  # "fakeredis://" ใช้ Redis จำลองภายใน process สำหรับทดสอบ
+REDIS_KEY_PREFIX = "smart_cooking"
+COUNTER_FILE = "visitor_count.txt"  # ไฟล์นับแบบเดิม ใช้ตั้งค่าเริ่มต้นของตัวนับครั้งแรกเท่านั้น
 ACTIVE_TIMEOUT = 20  # วินาทีที่ผู้ใช้ถูกนับเป็น active
+PRESENCE_REFRESH_INTERVAL = 5  # วินาที; rerun ที่ถี่กว่านี้ใช้ตัวเลขเดิมจาก session_state โดยไม่แตะฐานข้อมูล
+VISITOR_COUNTER = "visitors"
 
-def get_visitor_count():
+def read_legacy_visitor_count():
     try:
         with open(COUNTER_FILE, "r") as f:
             content = f.read().strip()
             return int(content) if content else 0
-    except FileNotFoundError:
-        with open(COUNTER_FILE, "w") as f:
-            f.write("0")
+    except (FileNotFoundError, ValueError):
         return 0
 
+class SQLiteStateStore:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError:
+            pass  # worker อื่นกำลังตั้ง WAL อยู่ (ค่านี้ถูกเก็บถาวรในไฟล์ฐานข้อมูล)
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS presence (session_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS presence_last_seen ON presence (last_seen)")
+        conn.execute("CREATE TABLE IF NOT EXISTS key_quota "
+                     "(key_id TEXT PRIMARY KEY, cooldown_until REAL NOT NULL, strikes INTEGER NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)",
+                     (VISITOR_COUNTER, read_legacy_visitor_count()))
+
+    def _connect(self):
+        # หนึ่ง connection ต่อ thread แบบ autocommit; การเขียนแต่ละครั้งเป็น statement เดียวที่ atomic อยู่แล้ว
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def increment(self, name):
+        conn = self._connect()
+        return conn.execute("INSERT INTO counters (name, value) VALUES (?, 1) "
+                            "ON CONFLICT(name) DO UPDATE SET value = value + 1 RETURNING value",
+                            (name,)).fetchone()[0]
+
+    def get(self, name):
+        row = self._connect().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def touch(self, session_id, now):
+        self._connect().execute("INSERT INTO presence (session_id, last_seen) VALUES (?, ?) "
+                                "ON CONFLICT(session_id) DO UPDATE SET last_seen = excluded.last_seen",
+                                (session_id, now))
+
+    def count_active(self, cutoff):
+        conn = self._connect()
+        # ลบเฉพาะช่วงที่หมดอายุผ่าน index ของ last_seen แทนการอ่านแล้วเขียนใหม่ทั้งไฟล์
+        conn.execute("DELETE FROM presence WHERE last_seen < ?", (cutoff,))
+        return conn.execute("SELECT COUNT(*) FROM presence").fetchone()[0]
+
+    def sessions(self):
+        return self._connect().execute("SELECT session_id, last_seen FROM presence ORDER BY last_seen").fetchall()
+
+    def reset(self):
+        conn = self._connect()
+        conn.execute("UPDATE counters SET value = 0")
+        conn.execute("DELETE FROM presence")
+
+    def key_quotas(self):
+        rows = self._connect().execute("SELECT key_id, cooldown_until, strikes FROM key_quota").fetchall()
+        return {key_id: (cooldown_until, strikes) for key_id, cooldown_until, strikes in rows}
+
+    def set_key_quota(self, key_id, cooldown_until, strikes):
+        self._connect().execute("INSERT OR REPLACE INTO key_quota (key_id, cooldown_until, strikes) VALUES (?, ?, ?)",
+                                (key_id, cooldown_until, strikes))
+
+class MemoryStateStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {VISITOR_COUNTER: read_legacy_visitor_count()}
+        self.presence = OrderedDict()  # เรียงตาม last_seen จากเก่าไปใหม่
+        self.quotas = {}
+
+    def increment(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            return self.counters[name]
+
+    def get(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def touch(self, session_id, now):
+        with self.lock:
+            self.presence[session_id] = now
+            self.presence.move_to_end(session_id)
+
+    def count_active(self, cutoff):
+        with self.lock:
+            while self.presence and next(iter(self.presence.values())) < cutoff:
+                self.presence.popitem(last=False)
+            return len(self.presence)
+
+    def sessions(self):
+        with self.lock:
+            return list(self.presence.items())
+
+    def reset(self):
+        with self.lock:
+            for name in self.counters:
+                self.counters[name] = 0
+            self.presence.clear()
+
+    def key_quotas(self):
+        with self.lock:
+            return dict(self.quotas)
+
+    def set_key_quota(self, key_id, cooldown_until, strikes):
+        with self.lock:
+            self.quotas[key_id] = (cooldown_until, strikes)
+
+class RedisStateStore:
+    def __init__(self, client):
+        self.client = client
+        self.presence_key = f"{REDIS_KEY_PREFIX}:presence"  # sorted set: session_id -> last_seen
+        self.quota_key = f"{REDIS_KEY_PREFIX}:key_quota"  # hash: key_id -> [cooldown_until, strikes]
+        try:
+            self.client.setnx(self._counter_key(VISITOR_COUNTER), read_legacy_visitor_count())
+        except redis.RedisError:
+            pass  # Redis ยังไม่พร้อมตอนเริ่ม process: ตัวนับเริ่มจาก INCR ครั้งแรกแทน ไม่ให้ทั้งแอปเริ่มไม่ได้
+
+    def _counter_key(self, name):
+        return f"{REDIS_KEY_PREFIX}:counter:{name}"
+
+    def increment(self, name):
+        return self.client.incr(self._counter_key(name))
+
+    def get(self, name):
+        value = self.client.get(self._counter_key(name))
+        return int(value) if value else 0
+
+    def touch(self, session_id, now):
+        self.client.zadd(self.presence_key, {session_id: now})
+
+    def count_active(self, cutoff):
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(self.presence_key, "-inf", f"({cutoff}")
+        pipe.zcard(self.presence_key)
+        return pipe.execute()[1]
+
+    def sessions(self):
+        return self.client.zrange(self.presence_key, 0, -1, withscores=True)
+
+    def reset(self):
+        pipe = self.client.pipeline()
+        for key in self.client.scan_iter(match=self._counter_key("*")):
+            pipe.set(key, 0)
+        pipe.delete(self.presence_key)
+        pipe.execute()
+
+    def key_quotas(self):
+        return {key_id: tuple(json.loads(value)) for key_id, value in self.client.hgetall(self.quota_key).items()}
+
+    def set_key_quota(self, key_id, cooldown_until, strikes):
+        self.client.hset(self.quota_key, key_id, json.dumps([cooldown_until, strikes]))
+
+@st.cache_resource
+def get_redis_client():
+    if REDIS_URL.startswith("fakeredis://"):
+        import fakeredis
+        return fakeredis.FakeRedis(decode_responses=True)
+    if redis is None:
+        raise RuntimeError("STATE_BACKEND=redis ต้องติดตั้งแพ็กเกจ redis ก่อน (pip install redis)")
+    return redis.Redis.from_url(REDIS_URL, decode_responses=True)
+
+@st.cache_resource
+def get_state_store():
+    if STATE_BACKEND == "redis":
+        return RedisStateStore(get_redis_client())
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore()
+    return SQLiteStateStore(STATE_DB_FILE)
+
+# ข้อผิดพลาดเมื่อ shared state ใช้ไม่ได้ชั่วคราว (Redis ติดต่อไม่ได้, SQLite ถูก lock นานเกินไป)
+# ผู้เรียกที่ไม่จำเป็นต้องใช้ค่าร่วมจะจับไว้แล้วใช้ค่าในเครื่องต่อ เหมือน RedisResponseStore
+STATE_STORE_ERRORS = (sqlite3.Error,) + ((redis.RedisError,) if redis is not None else ())
+
+def get_visitor_count():
+    return get_state_store().get(VISITOR_COUNTER)
+
+@timed("increment_visitor_count")
 def increment_visitor_count():
-    count = get_visitor_count() + 1
-    with open(COUNTER_FILE, "w") as f:
-        f.write(str(count))
-    return count
+    return get_state_store().increment(VISITOR_COUNTER)
 
+@timed("get_active_users")
 def get_active_users():
-    current_time = time.time()
-    active_users = {}
-    try:
-        with open(ACTIVE_USERS_FILE, "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line or "," not in line:
-                    continue
-                user_id, last_seen = line.split(",")
-                if current_time - float(last_seen) <= ACTIVE_TIMEOUT:
-                    active_users[user_id] = last_seen
-    except FileNotFoundError:
-        pass
-
-    with open(ACTIVE_USERS_FILE, "w") as f:
-        for user_id, last_seen in active_users.items():
-            f.write(f"{user_id},{last_seen}\n")
-    return len(active_users)
+    return get_state_store().count_active(time.time() - ACTIVE_TIMEOUT)
 
+@timed("update_active_user")
 def update_active_user():
     if "session_id" not in st.session_state:
         st.session_state.session_id = str(uuid.uuid4())
-    user_id = st.session_state.session_id
-    current_time = time.time()
-    active_users = {}
+    get_state_store().touch(st.session_state.session_id, time.time())
+
+def track_presence():
+    # นับ Page View ครั้งเดียวต่อ session และอัปเดตสถานะ active อย่างมากทุก PRESENCE_REFRESH_INTERVAL วินาที
+    state = st.session_state
+    now = time.time()
     try:
-        with open(ACTIVE_USERS_FILE, "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line or "," not in line:
-                    continue
-                parts = line.split(",")
-                if len(parts) != 2:
-                    continue
-                existing_user_id, last_seen = parts
-                active_users[existing_user_id] = last_seen
-    except FileNotFoundError:
-        pass
-    active_users[user_id] = str(current_time)
-    with open(ACTIVE_USERS_FILE, "w") as f:
-        for uid, last_seen in active_users.items():
-            f.write(f"{uid},{last_seen}\n")
+        if "visitor_count" not in state:
+            state.visitor_count = increment_visitor_count()
+            state.presence_refreshed_at = 0.0
+        if now - state.presence_refreshed_at >= PRESENCE_REFRESH_INTERVAL:
+            update_active_user()
+            state.active_users = get_active_users()
+            if state.presence_refreshed_at:
+                state.visitor_count = get_visitor_count()
+            state.presence_refreshed_at = now
+    except STATE_STORE_ERRORS:
+        # แสดงตัวเลขเดิมของ session แทนการทำให้ทั้งหน้าเว็บล่ม แล้วลองใหม่ในรอบ refresh ถัดไป
+        get_metrics().incr("state_store_errors", op="presence")
+        if "visitor_count" in state:
+            state.presence_refreshed_at = now
+    return state.get("visitor_count", 0), state.get("active_users", 0)
 
 # --- API Key Setup ---
 API_KEYS = st.secrets["API_KEYS"]
 
+MODEL_NAME = "gemini-2.0-flash"
+
+# --- Response Cache สำหรับคำตอบจาก Gemini (LRU ในหน่วยความจำ + ชั้นที่สองที่แชร์ระหว่าง worker: SQLite หรือ Redis) ---
+CACHE_TTL = int(os.environ.get("CACHE_TTL", str(6 * 60 * 60)))  # วินาทีที่คำตอบใน cache ยังถือว่าใช้ได้
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "256"))  # จำนวนคำตอบสูงสุดใน cache ระดับ process
+CACHE_DB_FILE = "response_cache.db"  # ตั้งเป็น None เพื่อปิด cache บนดิสก์ (เมื่อ STATE_BACKEND ไม่ใช่ redis)
+CACHE_DB_MAX_ENTRIES = int(os.environ.get("CACHE_DB_MAX_ENTRIES", "5000"))  # จำนวนคำตอบสูงสุดใน cache บนดิสก์ (แชร์ระหว่าง worker)
+
+class SQLiteResponseStore:
+    def __init__(self, db_file, ttl, max_entries):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                         "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=5)
+
+    def load(self, key):
+        try:
+            with self._connect() as conn:
+                return conn.execute("SELECT response, created_at FROM responses WHERE key = ? AND created_at >= ?",
+                                    (key, time.time() - self.ttl)).fetchone()
+        except sqlite3.Error:
+            return None
+
+    def contains(self, key):
+        try:
+            with self._connect() as conn:
+                return conn.execute("SELECT 1 FROM responses WHERE key = ? AND created_at >= ?",
+                                    (key, time.time() - self.ttl)).fetchone() is not None
+        except sqlite3.Error:
+            return False
+
+    def save(self, key, response, created_at):
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                             (key, response, created_at))
+                conn.execute("DELETE FROM responses WHERE created_at < ?", (created_at - self.ttl,))
+                conn.execute("DELETE FROM responses WHERE key IN "
+                             "(SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                             (self.max_entries,))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+class RedisResponseStore:
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    def _key(self, key):
+        return f"{REDIS_KEY_PREFIX}:response:{key}"
+
+    def load(self, key):
+        # Redis ลบคำตอบที่หมดอายุเองตาม TTL ที่ตั้งตอนบันทึก
+        try:
+            value = self.client.get(self._key(key))
+        except redis.RedisError:
+            return None
+        return tuple(json.loads(value)) if value is not None else None
+
+    def contains(self, key):
+        try:
+            return bool(self.client.exists(self._key(key)))
+        except redis.RedisError:
+            return False
+
+    def save(self, key, response, created_at):
+        try:
+            self.client.set(self._key(key), json.dumps([response, created_at], ensure_ascii=False), ex=self.ttl)
+        except redis.RedisError:
+            pass
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self._key("*")))
+        if keys:
+            self.client.delete(*keys)
+
+class ResponseCache:
+    def __init__(self, ttl, max_entries, store=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.store = store
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bypass = False
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(prompt, model_name, generation_config=None):
+        # ช่องว่างที่ต่างกันไม่ควรทำให้ได้ key คนละตัว
+        normalized = " ".join(prompt.split())
+        if generation_config:
+            # เพดาน token ต่างกันให้คำตอบต่างกัน; คำขอที่ไม่ตั้งค่าใช้ key เดิมเพื่อไม่ให้ cache เก่าใช้ไม่ได้
+            model_name = f"{model_name}\n{json.dumps(generation_config, sort_keys=True)}"
+        return hashlib.sha256(f"{model_name}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                response, created_at = entry
+                if now - created_at <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self.entries[key]
+        row = self.store.load(key) if self.store else None
+        if row is not None:
+            with self.lock:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                self.shared_hits += 1
+            return row[0]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def contains(self, key):
+        # ตรวจว่ามีคำตอบที่ยังไม่หมดอายุหรือไม่ โดยไม่นับเป็น hit/miss และไม่ขยับลำดับ LRU
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[1] <= self.ttl:
+                return True
+        return self.store.contains(key) if self.store else False
+
+    def set(self, key, response):
+        if self.bypass:
+            return
+        now = time.time()
+        with self.lock:
+            self._remember(key, response, now)
+        if self.store:
+            self.store.save(key, response, now)
+
+    def _remember(self, key, response, created_at):
+        self.entries[key] = (response, created_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.shared_hits = self.misses = 0
+        if self.store:
+            self.store.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+@st.cache_resource
+def get_response_cache():
+    if STATE_BACKEND == "redis":
+        store = RedisResponseStore(get_redis_client(), CACHE_TTL)
+    elif CACHE_DB_FILE:
+        store = SQLiteResponseStore(CACHE_DB_FILE, CACHE_TTL, CACHE_DB_MAX_ENTRIES)
+    else:
+        store = None
+    return ResponseCache(CACHE_TTL, CACHE_MAX_ENTRIES, store)
+
+# --- Model Backend: ทุก backend คืน object ที่มี generate_content(prompt, stream) และ chunk ที่มี .text เหมือน Gemini ---
+# "gemini" เรียก API จริง, "replay" ตอบจากคำตอบที่บันทึกไว้, "synthetic" (หรือ "fake") สร้างคำตอบจำลองตาม latency/ความผิดพลาดที่ตั้งไว้
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "gemini")
+RECORD_FIXTURES = os.environ.get("RECORD_FIXTURES")  # ตั้งเป็น path ของไฟล์ JSONL เพื่อบันทึกคำตอบจริงจาก Gemini ไว้ replay
+REPLAY_FIXTURES = os.environ.get("REPLAY_FIXTURES", "fixtures/gemini_responses.jsonl")
+REPLAY_SPEED = float(os.environ.get("REPLAY_SPEED", "1"))  # 2 = เร็วกว่าที่บันทึกไว้สองเท่า, 0 = ไม่หน่วงเวลาเลย
+REPLAY_STRICT = os.environ.get("REPLAY_STRICT", "0") == "1"  # "1" = prompt ที่ไม่ได้บันทึกไว้เป็น error แทนการใช้คำตอบใกล้เคียง
+SYNTHETIC_LATENCY = float(os.environ.get("SYNTHETIC_LATENCY", "0"))  # ค่ามัธยฐาน (วินาที) ของเวลาก่อน chunk แรก
+SYNTHETIC_LATENCY_SIGMA = float(os.environ.get("SYNTHETIC_LATENCY_SIGMA", "0.5"))  # ความกว้างของการแจกแจงแบบ lognormal
+SYNTHETIC_CHUNK_DELAY = float(os.environ.get("SYNTHETIC_CHUNK_DELAY", "0.05"))  # วินาทีระหว่างแต่ละ chunk
+SYNTHETIC_FAILURE_RATE = float(os.environ.get("SYNTHETIC_FAILURE_RATE", "0"))  # สัดส่วนคำขอที่ล้มเหลวกลางสตรีม
+SYNTHETIC_QUOTA_RATE = float(os.environ.get("SYNTHETIC_QUOTA_RATE", "0"))  # สัดส่วนคำขอที่ถูกปฏิเสธว่าหมดโควต้า
+SYNTHETIC_KEY_RPM = int(os.environ.get("SYNTHETIC_KEY_RPM", "0"))  # คำขอต่อนาทีต่อ key ก่อนหมดโควต้า (0 = ไม่จำกัด)
+SYNTHETIC_SEED = os.environ.get("SYNTHETIC_SEED", "0")
+SYNTHETIC_CHARS_PER_TOKEN = 3  # ใช้ประมาณจำนวน token ของโมเดลจำลอง
+
+# generation_config ต่อ (โหมด, ระดับ): "full" คือคำตอบครบในครั้งเดียวแบบเดิม, "summary" คือชื่อเมนูและจุดเด่นแบบสั้น,
+# "detail" คือสูตรเต็มของเมนูเดียวที่โหลดเมื่อผู้ใช้กดดู; แก้ทับได้ด้วย GENERATION_CONFIG='{"create/summary": {...}}'
+# max_output_tokens เป็นเพดานกันคำตอบยาวผิดปกติ ไม่ใช่ตัวกำหนดความยาว จึงเผื่อไว้ราว 2-3 เท่าของขนาดคำตอบปกติ
+# ควรปรับตาม p99 ของ gemini_output_tokens และจำนวน gemini_calls ที่ outcome=truncated ใน Admin Panel
+GENERATION_CONFIGS = {
+    ("create", "full"): {},
+    ("search", "full"): {},
+    ("create", "summary"): {"max_output_tokens": 1024},
+    ("search", "summary"): {"max_output_tokens": 1024},
+    ("create", "detail"): {"max_output_tokens": 2048},
+    ("search", "detail"): {"max_output_tokens": 1024},
+}
+for generation_name, generation_override in json.loads(os.environ.get("GENERATION_CONFIG", "{}")).items():
+    GENERATION_CONFIGS[tuple(generation_name.split("/"))] = generation_override
+
+def generation_config(generation):
+    return GENERATION_CONFIGS.get(generation) or None
+
+def response_key(prompt, generation):
+    return ResponseCache.make_key(prompt, MODEL_NAME, generation_config(generation))
+
+class FakeChunk:
+    def __init__(self, text, usage_metadata=None, finish_reason=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        # เหมือน Gemini: เหตุผลที่จบคำตอบอยู่ใน candidates ของ chunk สุดท้าย
+        self.candidates = [types.SimpleNamespace(finish_reason=finish_reason)] if finish_reason else None
+
+def finish_reason(chunk):
+    candidates = getattr(chunk, "candidates", None)
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(reason, "name", reason)  # google.genai ให้เป็น enum ส่วน backend อื่นให้เป็นข้อความ
+
+class SyntheticModel:
+    def __init__(self, api_key):
+        self.random = random.Random(f"{SYNTHETIC_SEED}:{api_key}")
+        self.lock = threading.Lock()
+        self.calls = deque()  # เวลาที่ถูกเรียกภายในหนึ่งนาทีล่าสุด สำหรับจำลองโควต้าต่อ key
+
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        response_text = "\n".join(json.dumps({
+            "name": f"เมนูทดสอบ {i}",
+            "ingredients": [{"item": "ไข่", "quantity": "2 ฟอง"}, {"item": "หมูสับ", "quantity": "100 กรัม"}],
+            "missing": ["ต้นหอม"],
+            "steps": ["ตั้งกระทะให้ร้อน", f"ผัดให้สุกแล้วปรุงรสตามชอบ (คำขอ: {prompt[:40]})"],
+            "price": "", "shop": "",
+        }, ensure_ascii=False) for i in range(1, 4))
+        max_output_tokens = (generation_config or {}).get("max_output_tokens")
+        finish = "STOP"
+        if max_output_tokens and len(response_text) > max_output_tokens * SYNTHETIC_CHARS_PER_TOKEN:
+            response_text = response_text[:max_output_tokens * SYNTHETIC_CHARS_PER_TOKEN]
+            finish = "MAX_TOKENS"
+        usage = types.SimpleNamespace(prompt_token_count=len(prompt) // SYNTHETIC_CHARS_PER_TOKEN,
+                                      candidates_token_count=len(response_text) // SYNTHETIC_CHARS_PER_TOKEN)
+        with self.lock:
+            now = time.time()
+            while self.calls and self.calls[0] < now - 60:
+                self.calls.popleft()
+            self.calls.append(now)
+            over_rpm = SYNTHETIC_KEY_RPM and len(self.calls) > SYNTHETIC_KEY_RPM
+            quota_error = over_rpm or self.random.random() < SYNTHETIC_QUOTA_RATE
+            fail_at = (self.random.randrange(len(response_text))
+                       if self.random.random() < SYNTHETIC_FAILURE_RATE else None)
+            latency = (self.random.lognormvariate(math.log(SYNTHETIC_LATENCY), SYNTHETIC_LATENCY_SIGMA)
+                       if SYNTHETIC_LATENCY > 0 else 0.0)
+        if quota_error:
+            # API จริงปฏิเสธตั้งแต่ก่อนส่ง chunk แรก
+            raise Exception("429 Quota exceeded (synthetic)")
+        if not stream:
+            time.sleep(latency)
+            if fail_at is not None:
+                raise Exception("500 Internal error (synthetic)")
+            return FakeChunk(response_text, usage, finish)
+        return self._stream(response_text, latency, fail_at, usage, finish)
+
+    def _stream(self, response_text, latency, fail_at, usage, finish):
+        time.sleep(latency)
+        for start in range(0, len(response_text), 16):
+            if fail_at is not None and start >= fail_at:
+                raise Exception("500 Internal error (synthetic)")
+            time.sleep(SYNTHETIC_CHUNK_DELAY)
+            # เหมือน Gemini: chunk สุดท้ายมีจำนวน token ของทั้งคำตอบและเหตุผลที่จบ
+            last = start + 16 >= len(response_text)
+            yield FakeChunk(response_text[start:start + 16], usage if last else None, finish if last else None)
+
+@st.cache_resource
+def get_replay_corpus():
+    corpus = {}
+    with open(REPLAY_FIXTURES, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                corpus[record["key"]] = record
+    return corpus
+
+class ReplayModel:
+    def __init__(self, api_key):
+        self.corpus = get_replay_corpus()
+        self.by_config = {}
+        for record in self.corpus.values():
+            self.by_config.setdefault(json.dumps(record["generation_config"], sort_keys=True), []).append(record)
+
+    def _lookup(self, prompt, generation_config):
+        record = self.corpus.get(ResponseCache.make_key(prompt, MODEL_NAME, generation_config))
+        if record is not None or REPLAY_STRICT:
+            return record
+        # load test สร้างชุดตัวเลือกที่ไม่ได้บันทึกไว้: ใช้คำตอบที่บันทึกไว้ของ generation_config เดียวกันแทน
+        # เลือกตาม hash ของ prompt จึงได้คำตอบเดิมทุกครั้งที่ถาม prompt เดิม
+        candidates = self.by_config.get(json.dumps(generation_config, sort_keys=True))
+        if not candidates:
+            return None
+        return candidates[int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16) % len(candidates)]
+
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        record = self._lookup(prompt, generation_config)
+        if record is None:
+            raise Exception("replay: ไม่มีคำตอบที่บันทึกไว้สำหรับ prompt นี้")
+        if not stream:
+            return FakeChunk("".join(record["chunks"]), finish_reason=record.get("finish_reason"))
+        return self._stream(record)
+
+    def _stream(self, record):
+        # เล่นซ้ำตามจังหวะที่บันทึกไว้: รอจนถึงเวลาของ chunk แรก แล้วกระจายเวลาที่เหลือให้ chunk ถัดไปเท่าๆ กัน
+        chunks = record["chunks"]
+        speed = REPLAY_SPEED or float("inf")
+        time.sleep(record["first_chunk_seconds"] / speed)
+        gap = (record["total_seconds"] - record["first_chunk_seconds"]) / max(1, len(chunks) - 1) / speed
+        for n, text in enumerate(chunks):
+            if n:
+                time.sleep(gap)
+            yield FakeChunk(text, finish_reason=record.get("finish_reason") if n == len(chunks) - 1 else None)
+
+class RecordingModel:
+    lock = threading.Lock()
+
+    def __init__(self, model, fixtures_file):
+        self.model = model
+        self.fixtures_file = fixtures_file
+
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        if not stream:
+            return self.model.generate_content(prompt, generation_config=generation_config)
+        return self._record(prompt, generation_config,
+                            self.model.generate_content(prompt, stream=True, generation_config=generation_config))
+
+    def _record(self, prompt, generation_config, response):
+        started = time.time()
+        chunks = []
+        first_chunk_seconds = None
+        finish = None
+        for chunk in response:
+            if first_chunk_seconds is None:
+                first_chunk_seconds = time.time() - started
+            chunks.append(chunk.text or "")
+            finish = finish_reason(chunk) or finish
+            yield chunk
+        # บันทึกเฉพาะคำตอบที่สตรีมครบ คำตอบที่ error กลางทางจะไม่ถูกเก็บ
+        record = {"key": ResponseCache.make_key(prompt, MODEL_NAME, generation_config), "prompt": prompt,
+                  "generation_config": generation_config, "chunks": chunks, "finish_reason": finish,
+                  "first_chunk_seconds": first_chunk_seconds or 0.0, "total_seconds": time.time() - started}
+        with self.lock:
+            os.makedirs(os.path.dirname(self.fixtures_file) or ".", exist_ok=True)
+            with open(self.fixtures_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+class GeminiModel:
+    # google.genai.Client รับ api_key ต่อ client ได้โดยตรง จึงมีหนึ่ง client ต่อ key โดยไม่ต้องแก้ค่าระดับ module
+    def __init__(self, api_key):
+        self.client = genai.Client(api_key=api_key)
+
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        config = genai_types.GenerateContentConfig(**generation_config) if generation_config else None
+        if stream:
+            return self.client.models.generate_content_stream(model=MODEL_NAME, contents=prompt, config=config)
+        return self.client.models.generate_content(model=MODEL_NAME, contents=prompt, config=config)
+
+MODEL_BACKENDS = {
+    "gemini": GeminiModel,
+    "replay": ReplayModel,
+    "synthetic": SyntheticModel,
+    "fake": SyntheticModel,
+}
+
+def get_model(api_key):
+    model = MODEL_BACKENDS[MODEL_BACKEND](api_key)
+    if RECORD_FIXTURES:
+        model = RecordingModel(model, RECORD_FIXTURES)
+    return model
+
+QUOTA_ERROR_MARKERS = ("insufficient_quota", "Quota exceeded", "RESOURCE_EXHAUSTED")
+
+def is_quota_error(error_message):
+    return any(marker in error_message for marker in QUOTA_ERROR_MARKERS)
+
+# --- API Key Pool: กระจายโหลดระหว่าง key และพัก key ที่เพิ่งหมดโควต้า ---
+KEY_COOLDOWN_BASE = 30  # วินาทีที่พัก key หลังเจอ quota error ครั้งแรก (เพิ่มเป็นเท่าตัวเมื่อเจอซ้ำ)
+KEY_COOLDOWN_MAX = 15 * 60
+KEY_LATENCY_SMOOTHING = 0.2  # น้ำหนักของ latency ล่าสุดในค่าเฉลี่ยแบบ EWMA
+
+class KeyState:
+    def __init__(self, index, api_key):
+        self.index = index
+        self.api_key = api_key
+        self.key_id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]  # ใช้ใน shared state แทนตัว key จริง
+        self.model = None
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.quota_errors = 0
+        self.consecutive_quota_errors = 0
+        self.cooldown_until = 0.0
+        self.latency = None
+
+    @property
+    def label(self):
+        return f"#{self.index + 1} (…{self.api_key[-4:]})"
+
+class KeyPool:
+    def __init__(self, api_keys, state=None):
+        self.keys = [KeyState(i, api_key) for i, api_key in enumerate(api_keys)]
+        self.state = state
+        self.lock = threading.Lock()
+        self.next_index = 0
+
+    def _sync_quotas(self):
+        # ช่วงพักของ key อยู่ใน shared state ทำให้ทุก replica หลบ key ที่เพิ่งหมดโควต้าพร้อมกัน
+        if self.state is None:
+            return
+        try:
+            quotas = self.state.key_quotas()
+        except STATE_STORE_ERRORS:
+            # shared state ใช้ไม่ได้ชั่วคราว: ใช้ช่วงพักใน KeyState ของ process นี้ต่อไป
+            get_metrics().incr("state_store_errors", op="key_quota_sync")
+            return
+        with self.lock:
+            for key_state in self.keys:
+                if key_state.key_id in quotas:
+                    key_state.cooldown_until, key_state.consecutive_quota_errors = quotas[key_state.key_id]
+
+    def _publish_quota(self, key_state):
+        if self.state is None:
+            return
+        try:
+            self.state.set_key_quota(key_state.key_id, key_state.cooldown_until, key_state.consecutive_quota_errors)
+        except STATE_STORE_ERRORS:
+            # replica อื่นจะไม่รู้ช่วงพักนี้ แต่ process นี้ยังหลบ key ได้จาก KeyState ของตัวเอง
+            get_metrics().incr("state_store_errors", op="key_quota_publish")
+
+    def acquire(self, exclude=()):
+        self._sync_quotas()
+        now = time.time()
+        with self.lock:
+            # เลือก key ที่มีงานค้างน้อยที่สุด ถ้าเท่ากันให้วนแบบ round-robin
+            chosen = None
+            for offset in range(len(self.keys)):
+                key_state = self.keys[(self.next_index + offset) % len(self.keys)]
+                if key_state.index in exclude or key_state.cooldown_until > now:
+                    continue
+                if chosen is None or key_state.in_flight < chosen.in_flight:
+                    chosen = key_state
+            if chosen is None:
+                return None
+            self.next_index = (chosen.index + 1) % len(self.keys)
+            chosen.in_flight += 1
+            chosen.requests += 1
+            if chosen.model is None:
+                chosen.model = get_model(chosen.api_key)
+            return chosen
+
+    def release(self, key_state, latency, error_message=None):
+        with self.lock:
+            key_state.in_flight -= 1
+            quota_changed = False
+            if error_message is None:
+                quota_changed = key_state.consecutive_quota_errors > 0
+                key_state.consecutive_quota_errors = 0
+                if key_state.latency is None:
+                    key_state.latency = latency
+                else:
+                    key_state.latency += KEY_LATENCY_SMOOTHING * (latency - key_state.latency)
+            elif is_quota_error(error_message):
+                key_state.quota_errors += 1
+                key_state.consecutive_quota_errors += 1
+                cooldown = KEY_COOLDOWN_BASE * 2 ** (key_state.consecutive_quota_errors - 1)
+                key_state.cooldown_until = time.time() + min(cooldown, KEY_COOLDOWN_MAX)
+                quota_changed = True
+            else:
+                key_state.errors += 1
+        if quota_changed:
+            self._publish_quota(key_state)
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return [{
+                "key": key_state.label,
+                "in_flight": key_state.in_flight,
+                "requests": key_state.requests,
+                "errors": key_state.errors,
+                "quota_errors": key_state.quota_errors,
+                "error_rate": f"{(key_state.errors + key_state.quota_errors) / key_state.requests:.0%}"
+                              if key_state.requests else "-",
+                "latency_s": f"{key_state.latency:.2f}" if key_state.latency is not None else "-",
+                "cooldown_s": max(0, int(key_state.cooldown_until - now)),
+            } for key_state in self.keys]
+
+# แชร์ช่วงพักของ key ข้าม replica เฉพาะเมื่อเรียก API จริงจากหน้าเว็บ backend จำลองและ --loadtest ใช้สถานะของตัวเอง
+# ไม่อย่างนั้น quota error ปลอมหรือการยิงโหลดจะทำให้ replica ที่ให้บริการจริงพัก key จริงตามไปด้วย
+SHARE_KEY_QUOTAS = MODEL_BACKEND == "gemini" and "--loadtest" not in sys.argv
+
+@st.cache_resource
+def get_key_pool():
+    return KeyPool(API_KEYS, get_state_store() if SHARE_KEY_QUOTAS else None)
+
+# --- Single-flight: คำขอที่ prompt ตรงกันและกำลังรอพร้อมกันจะใช้การเรียก API ครั้งเดียวร่วมกัน ---
+SINGLE_FLIGHT_TIMEOUT = 90  # วินาทีสูงสุดที่ผู้รอแต่ละคนจะรอผลจากคำขอต้นทาง
+
+class Flight:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.cond = threading.Condition()
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def join(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = Flight()
+            self.flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def lead(self, key):
+        # เริ่ม flight ใหม่เฉพาะเมื่อยังไม่มีใครเรียก prompt นี้อยู่ (ใช้กับงานเบื้องหลังที่ไม่ต้องรอผล)
+        with self.lock:
+            if key in self.flights:
+                return None
+            flight = Flight()
+            self.flights[key] = flight
+            self.leaders += 1
+            return flight
+
+    def publish(self, flight, chunk):
+        with flight.cond:
+            flight.chunks.append(chunk)
+            flight.cond.notify_all()
+
+    def finish(self, key, flight):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        with flight.cond:
+            flight.done = True
+            flight.cond.notify_all()
+
+    def follow(self, flight, timeout):
+        # yield chunk ตามคำขอต้นทางไปเรื่อยๆ จนกว่าคำขอต้นทางจะจบ
+        deadline = time.time() + timeout
+        sent = 0
+        while True:
+            with flight.cond:
+                while sent == len(flight.chunks) and not flight.done:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        with self.lock:
+                            self.timeouts += 1
+                        raise TimeoutError
+                    flight.cond.wait(remaining)
+                new_chunks = flight.chunks[sent:]
+                done = flight.done
+            for chunk in new_chunks:
+                yield chunk
+            sent += len(new_chunks)
+            if done:
+                return
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": len(self.flights), "leaders": self.leaders,
+                    "coalesced": self.coalesced, "timeouts": self.timeouts}
+
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
 # --- Helper Functions ---
-def call_gemini_api(prompt):
-    for api_key in API_KEYS:
+class StreamError(str):
+    # chunk ที่เป็นข้อความแจ้งข้อผิดพลาด ไม่ใช่ส่วนหนึ่งของคำตอบ ผู้รับจึงแยกผลสำเร็จ/ล้มเหลวได้โดยไม่ต้องเดาจากข้อความ
+    pass
+
+def stream_failed(chunks):
+    return any(isinstance(chunk, StreamError) for chunk in chunks)
+
+def stream_from_key_pool(prompt, cache, cache_key, generation, exclude=(), on_call=None):
+    pool = get_key_pool()
+    metrics = get_metrics()
+    mode, tier = generation
+    config = generation_config(generation)
+    tried = set(exclude)
+    while True:
+        key_state = pool.acquire(exclude=tried)
+        if key_state is None:
+            break
+        tried.add(key_state.index)
+        if on_call is not None:
+            on_call(key_state)
+        chunks = []
+        usage = None
+        finish = None
+        error_message = None
+        started = time.time()
         try:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel("gemini-2.0-flash")
-            response = model.generate_content(prompt)
-            return response.text.strip()
+            for chunk in key_state.model.generate_content(prompt, stream=True, generation_config=config):
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                finish = finish_reason(chunk) or finish
+                # chunk สุดท้ายของ google.genai อาจมีแค่ข้อมูลการจบโดยไม่มีข้อความ
+                if chunk.text:
+                    if not chunks:
+                        metrics.observe("gemini_first_chunk_seconds", time.time() - started,
+                                        key=key_state.label, tier=tier)
+                    chunks.append(chunk.text)
+                    yield chunk.text
         except Exception as e:
             error_message = str(e)
-            if "insufficient_quota" in error_message or "Quota exceeded" in error_message:
-                continue
+        finally:
+            latency = time.time() - started
+            pool.release(key_state, latency, error_message)
+            if error_message is None:
+                outcome = "truncated" if finish == "MAX_TOKENS" else "ok"
+            else:
+                outcome = "quota" if is_quota_error(error_message) else "error"
+            metrics.observe("gemini_call_seconds", latency, key=key_state.label, outcome=outcome, tier=tier)
+            metrics.incr("gemini_calls", key=key_state.label, outcome=outcome)
+            if usage is not None:
+                # chunk สุดท้ายของสตรีมมีจำนวน token รวมของทั้งคำขอ แต่ถ้าสตรีมล้มกลางทาง chunk ก่อนหน้า
+                # อาจมีแค่ prompt_token_count (ค่าใน google.genai เป็น None ได้) จึงข้ามค่าที่ไม่มี
+                for kind, count in (("prompt", usage.prompt_token_count), ("output", usage.candidates_token_count)):
+                    if count is not None:
+                        metrics.observe(f"gemini_{kind}_tokens", count, mode=mode, tier=tier)
+                        metrics.incr("gemini_tokens", count, kind=kind, tier=tier)
+        if error_message is None and finish == "MAX_TOKENS":
+            # คำตอบถูกตัดที่เพดาน max_output_tokens: key ทำงานปกติ แต่ไม่เก็บคำตอบที่ไม่ครบไว้ใช้ซ้ำ
+            yield StreamError("✂️ คำตอบยาวเกินขีดจำกัดและถูกตัดกลางทาง กรุณาลองใหม่อีกครั้ง")
+            return
+        if error_message is None:
+            cache.set(cache_key, "".join(chunks).strip())
+            return
+        # ถ้าเริ่มสตรีมไปแล้วจะสลับ key ไม่ได้ เพราะผู้ใช้เห็นข้อความบางส่วนแล้ว
+        if not chunks and is_quota_error(error_message):
+            continue
+        yield StreamError(f"❌ เกิดข้อผิดพลาด: {error_message}")
+        return
+    yield StreamError("⚠️ API ทั้งหมดหมดโควต้าแล้ว กรุณาตรวจสอบบัญชีของคุณ")
+
+# --- Worker Pool: จำกัดจำนวนการเรียก API พร้อมกัน เข้าคิวแบบ FIFO และปฏิเสธงานเมื่อคิวเต็ม ---
+MAX_UPSTREAM_CALLS = 8  # จำนวนการเรียก API พร้อมกันสูงสุดต่อ process
+MAX_QUEUED_JOBS = 32  # จำนวนงานที่รอคิวได้ เกินจากนี้จะตอบว่าระบบไม่ว่างทันที
+JOB_DEADLINE = 30  # วินาทีที่งานรอในคิวได้ก่อนถูกตัดทิ้ง
+BUSY_MESSAGE = StreamError("🚦 ระบบกำลังมีผู้ใช้งานจำนวนมาก กรุณาลองใหม่อีกครั้งในอีกสักครู่")
+
+class WorkerPool:
+    def __init__(self, max_workers, max_queued):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini-worker")
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.total_wait = 0.0
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            self.submitted += 1
+        self.executor.submit(self._run, time.time(), fn, args)
+        return True
+
+    def _run(self, submitted_at, fn, args):
+        waited = time.time() - submitted_at
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.total_wait += waited
+            expired = waited > JOB_DEADLINE
+            if expired:
+                self.expired += 1
+        try:
+            fn(*args, expired=expired)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def stats(self):
+        with self.lock:
+            started = self.submitted - self.queued
+            return {"running": self.running, "queued": self.queued, "submitted": self.submitted,
+                    "rejected": self.rejected, "expired": self.expired,
+                    "avg_wait": self.total_wait / started if started else 0.0}
+
+@st.cache_resource
+def get_worker_pool():
+    return WorkerPool(MAX_UPSTREAM_CALLS, MAX_QUEUED_JOBS)
+
+def run_flight(prompt, cache, cache_key, flight, generation, exclude=(), on_call=None, expired=False):
+    # ทำงานใน worker thread จึงไม่ถูกยกเลิกเมื่อ session ที่สั่งงาน rerun กลางคัน
+    flights = get_single_flight()
+    try:
+        if expired:
+            flights.publish(flight, BUSY_MESSAGE)
+        else:
+            for chunk in stream_from_key_pool(prompt, cache, cache_key, generation, exclude, on_call):
+                flights.publish(flight, chunk)
+    except Exception as e:
+        flights.publish(flight, StreamError(f"❌ เกิดข้อผิดพลาด: {e}"))
+    finally:
+        flights.finish(cache_key, flight)
+
+def stream_gemini_api(prompt, generation):
+    cache = get_response_cache()
+    cache_key = response_key(prompt, generation)
+    cached_response = cache.get(cache_key)
+    if cached_response is not None:
+        yield cached_response
+        return
+    flights = get_single_flight()
+    flight, is_leader = flights.join(cache_key)
+    # ผู้ที่มาคนแรกส่งงานเข้า worker pool ส่วนทุก session (รวมถึงผู้ส่งงาน) รับ chunk จาก flight เดียวกัน
+    if is_leader and not get_worker_pool().submit(run_flight, prompt, cache, cache_key, flight, generation):
+        flights.publish(flight, BUSY_MESSAGE)
+        flights.finish(cache_key, flight)
+    try:
+        yield from flights.follow(flight, SINGLE_FLIGHT_TIMEOUT)
+    except TimeoutError:
+        yield StreamError("⏳ ระบบกำลังยุ่ง รอคำตอบนานเกินไป กรุณาลองใหม่อีกครั้ง")
+
+def call_gemini_api(prompt, generation):
+    return "".join(stream_gemini_api(prompt, generation)).strip()
+
+# --- Menu parsing: แปลงคำตอบ (JSON Lines หรือข้อความอิสระ) เป็นรายการ Menu ---
+MENU_SEPARATOR = "🍽️ เมนูที่"
+MENU_JSON_SCHEMA = ("{\"name\": \"ชื่อเมนู\", "
+                    "\"ingredients\": [{\"item\": \"วัตถุดิบ\", \"quantity\": \"ปริมาณ\"}], "
+                    "\"missing\": [\"วัตถุดิบที่ยังขาด\"], \"steps\": [\"ขั้นตอน\"], "
+                    "\"price\": \"ราคา\", \"shop\": \"ร้านที่หาซื้อได้\"}")
+MENU_SUMMARY_SCHEMA = ("{\"name\": \"ชื่อเมนู\", \"summary\": \"จุดเด่นไม่เกิน 1 ประโยค\", "
+                       "\"missing\": [\"วัตถุดิบที่ยังขาด\"], \"price\": \"ราคา\", \"shop\": \"ร้าน\"}")
+BOLD_PATTERN = re.compile(r"\*\*(.+?)\*\*|\*(.+?)\*")
+
+def menu_json_format(count, schema=MENU_JSON_SCHEMA):
+    return (f"ตอบเป็น JSON Lines เท่านั้น {count} บรรทัด บรรทัดละ 1 เมนู ไม่ต้องมี ``` หรือข้อความอื่น "
+            f"แต่ละบรรทัดมีรูปแบบ {schema} ใช้ค่าว่างสำหรับช่องที่ไม่เกี่ยวข้อง")
+
+def as_list(value):
+    # โมเดลบางครั้งตอบเป็นข้อความเดียวแทน list
+    if not value:
+        return []
+    return value if isinstance(value, list) else [value]
+
+class Menu:
+    def __init__(self, name="", ingredients=(), missing=(), steps=(), price="", shop="", text="", summary="",
+                 detailed=True):
+        self.name = name
+        self.ingredients = list(ingredients)  # [(วัตถุดิบ, ปริมาณ), ...]
+        self.missing = list(missing)
+        self.steps = list(steps)
+        self.price = price
+        self.shop = shop
+        self.text = text  # ข้อความดิบ เมื่อคำตอบไม่ได้อยู่ในรูป JSON
+        self.summary = summary
+        self.detailed = detailed  # False = ได้มาจากคำขอแบบสรุป ยังไม่มีสูตรเต็ม
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            return cls(text=str(data))
+        ingredients = []
+        for ingredient in as_list(data.get("ingredients")):
+            if isinstance(ingredient, dict):
+                ingredients.append((str(ingredient.get("item", "")), str(ingredient.get("quantity", ""))))
             else:
-                return f"❌ เกิดข้อผิดพลาด: {error_message}"
-    return "⚠️ API ทั้งหมดหมดโควต้าแล้ว กรุณาตรวจสอบบัญชีของคุณ"
+                ingredients.append((str(ingredient), ""))
+        return cls(name=str(data.get("name") or ""), ingredients=ingredients,
+                   missing=[str(item) for item in as_list(data.get("missing"))],
+                   steps=[str(step) for step in as_list(data.get("steps"))],
+                   price=str(data.get("price") or ""), shop=str(data.get("shop") or ""),
+                   text=str(data.get("text") or ""), summary=str(data.get("summary") or ""),
+                   detailed=bool(data.get("detailed", True)))
+
+    def to_dict(self):
+        return {"name": self.name,
+                "ingredients": [{"item": item, "quantity": quantity} for item, quantity in self.ingredients],
+                "missing": self.missing, "steps": self.steps, "price": self.price, "shop": self.shop,
+                "text": self.text, "summary": self.summary, "detailed": self.detailed}
 
+def parse_json_menu(line):
+    try:
+        data = json.loads(line.rstrip(","))
+    except ValueError:
+        return []
+    if isinstance(data, list):
+        return [Menu.from_dict(item) for item in data if isinstance(item, dict)]
+    if isinstance(data, dict) and data.get("name"):
+        return [Menu.from_dict(data)]
+    return []
+
+@timed("process_menus")
 def process_menus(response_text):
     menu_list = []
-    separators = ["🍽️ เมนูที่", "\n- ", "\n• ", "\n— ", "- ", "• "]
+    separators = [MENU_SEPARATOR, "\n- ", "\n• ", "\n— ", "- ", "• "]
     for sep in separators:
         if sep in response_text:
             menu_list = response_text.split(sep)
@@ -110,15 +1206,891 @@ def process_menus(response_text):
     menu_list = [menu.strip() for menu in menu_list if menu.strip()]
     return menu_list
 
+@timed("parse_menus")
+def parse_menus(response_text):
+    # อ่านทีละบรรทัดรอบเดียว: บรรทัดที่เป็น JSON กลายเป็น Menu ส่วนที่เหลือใช้ตัวแยกข้อความแบบเดิม
+    stripped = response_text.strip()
+    if stripped.startswith("["):
+        menus = parse_json_menu(stripped)
+        if menus:
+            return menus
+    menus = []
+    for line in stripped.splitlines():
+        line = line.strip()
+        if line.startswith("{"):
+            menus.extend(parse_json_menu(line))
+    if menus:
+        return menus
+    return [Menu(text=text) for text in process_menus(response_text) if text]
+
+class MenuStreamParser:
+    def __init__(self):
+        self.received = []
+        self.line = ""
+        self.menus = []
+        self.structured = None  # ยังไม่รู้จนกว่าจะเห็นตัวอักษรแรกที่ไม่ใช่ช่องว่าง
+        self.completed = []
+        self.current = ""
+        self.latest = []
+        self.error = None
+
+    def feed(self, chunk):
+        if isinstance(chunk, StreamError):
+            # ข้อผิดพลาดไม่ใช่ส่วนหนึ่งของคำตอบ จึงไม่ผ่านตัวแยก JSON Lines (ซึ่งจะทิ้งบรรทัดนี้ไป)
+            # แต่ต่อท้ายเป็น Menu ของตัวเอง ผู้ใช้จึงเห็นว่าคำตอบไม่ครบ และ is_error_result รู้ว่าล้มเหลว
+            self.error = Menu(text=chunk)
+            return self.latest + [self.error]
+        self.latest = self._parse(chunk)
+        return self.latest + ([self.error] if self.error else [])
+
+    def _parse(self, chunk):
+        self.received.append(chunk)
+        if self.structured is None and chunk.strip():
+            self.structured = chunk.lstrip()[0] in "{[`"
+        if self.structured:
+            lines = (self.line + chunk).split("\n")
+            self.line = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line.startswith("{"):
+                    self.menus.extend(parse_json_menu(line))
+            return list(self.menus)
+        # ข้อความอิสระ: สแกนเฉพาะข้อความหลังตัวคั่นล่าสุด
+        # ตัวคั่นสำรองอย่าง "- " อาจโผล่กลางเมนู จึงใช้เฉพาะตอนได้ข้อความครบแล้ว
+        self.current += chunk
+        if MENU_SEPARATOR in self.current:
+            parts = self.current.split(MENU_SEPARATOR)
+            self.completed.extend(part.strip() for part in parts[:-1] if part.strip())
+            self.current = parts[-1]
+        texts = self.completed + ([self.current.strip()] if self.current.strip() else [])
+        return [Menu(text=text) for text in texts]
+
+    def finish(self):
+        menus = parse_menus("".join(self.received)) if self.received else []
+        return menus + ([self.error] if self.error else [])
+
+def iter_menus(chunks):
+    parser = MenuStreamParser()
+    for chunk in chunks:
+        yield parser.feed(chunk)
+    yield parser.finish()
+
 def format_menu_text(menu):
-    # แปลง **bold** หรือ *bold* เป็น HTML <b> tag
-    menu = menu.replace("**", "<b>", 1).replace("**", "</b>", 1)
-    menu = menu.replace("*", "<b>", 1).replace("*", "</b>", 1)
-    menu = menu.replace("*", "<b>", 1).replace("*", "</b>", 1)
-    return menu
+    # แปลง **bold** หรือ *bold* เป็น HTML <b> tag ทุกตำแหน่งในรอบเดียว
+    return BOLD_PATTERN.sub(lambda match: f"<b>{match.group(1) or match.group(2)}</b>", menu)
+
+def menu_card_body(menu):
+    if menu.text or not menu.name:
+        return f"<p>{format_menu_text(menu.text)}</p>"
+    parts = [f"<p><b>{html.escape(menu.name)}</b></p>"]
+    if menu.summary:
+        parts.append(f"<p>📝 {html.escape(menu.summary)}</p>")
+    if menu.ingredients:
+        parts.append("<p>🥕 วัตถุดิบ:</p><ul>" + "".join(
+            f"<li>{html.escape(item)} {html.escape(quantity)}</li>" for item, quantity in menu.ingredients) + "</ul>")
+    if menu.missing:
+        parts.append(f"<p>⚠️ วัตถุดิบที่ยังขาด: {html.escape(', '.join(menu.missing))}</p>")
+    if menu.steps:
+        parts.append("<p>👩‍🍳 วิธีทำ:</p><ol>" + "".join(
+            f"<li>{html.escape(step)}</li>" for step in menu.steps) + "</ol>")
+    if menu.price:
+        parts.append(f"<p>💰 ราคา: {html.escape(menu.price)}</p>")
+    if menu.shop:
+        parts.append(f"<p>🏪 หาซื้อได้ที่: {html.escape(menu.shop)}</p>")
+    return "".join(parts)
+
+def menu_card_html(i, menu):
+    return f"""
+    <div class="menu-column">
+        <h4>🍽️ เมนูที่ {i+1}</h4>
+        {menu_card_body(menu)}
+    </div>
+    """
+
+def show_menus(chunks, spinner_text, empty_warning):
+    header = st.empty()
+    slots = [col.empty() for col in st.columns(3)]
+    rendered = [None] * 3
+    menu_list = []
+    with st.spinner(spinner_text):
+        for menu_list in iter_menus(chunks):
+            menus = [menu for menu in menu_list if not is_error_result([menu])]
+            if menus and rendered[0] is None:
+                header.markdown("<h3>🧑‍🍳 เมนูแนะนำ 3 เมนู:</h3>", unsafe_allow_html=True)
+            # วาดใหม่เฉพาะการ์ดที่ข้อความเปลี่ยน
+            for i, menu in enumerate(menus[:3]):
+                card_html = menu_card_html(i, menu)
+                if card_html != rendered[i]:
+                    slots[i].markdown(card_html, unsafe_allow_html=True)
+                    rendered[i] = card_html
+    if is_error_result(menu_list):
+        # การ์ดที่ได้มาก่อนเกิดข้อผิดพลาดยังแสดงอยู่ แต่หัวข้อบอกว่าคำตอบไม่ครบและจะไม่ถูกบันทึก
+        header.error(menu_list[-1].text)
+    elif not menu_list:
+        header.warning(empty_warning)
+    return menu_list
+
+# --- ประวัติผลลัพธ์ต่อ session: แสดงซ้ำ เปรียบเทียบ และสร้างใหม่เฉพาะบางเมนูโดยไม่ต้องเรียกโมเดลทั้งชุด ---
+HISTORY_MAX_ENTRIES = int(os.environ.get("HISTORY_MAX_ENTRIES", "10"))  # จำนวนผลลัพธ์ล่าสุดที่เก็บต่อ session
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", str(256 * 1024)))  # ขนาดรวมโดยประมาณของเมนูในประวัติต่อ session
+
+def get_history():
+    state = st.session_state
+    if "menu_history" not in state:
+        state.menu_history = deque()
+        state.menu_history_bytes = 0
+        state.menu_history_next_id = 1
+    return state.menu_history
+
+def menus_size(menu_list):
+    return sum(len(json.dumps(menu.to_dict(), ensure_ascii=False).encode("utf-8")) for menu in menu_list)
+
+def menu_title(menu):
+    return menu.name or menu.text.strip().split("\n")[0][:60]
+
+def is_error_result(menu_list):
+    # MenuStreamParser ต่อข้อผิดพลาดของสตรีมไว้ท้ายรายการ แม้จะได้เมนูบางส่วนมาก่อนแล้ว
+    return any(isinstance(menu.text, StreamError) for menu in menu_list)
+
+def record_history(mode, label, params, menu_list, source="live", tier="full"):
+    if not menu_list or is_error_result(menu_list):
+        return None
+    if tier == "summary":
+        for menu in menu_list:
+            menu.detailed = False
+    history = get_history()
+    state = st.session_state
+    entry = {"id": state.menu_history_next_id, "mode": mode, "label": label, "params": params,
+             "source": source, "tier": tier, "menus": list(menu_list[:3]), "created_at": time.time()}
+    entry["size"] = menus_size(entry["menus"])
+    state.menu_history_next_id += 1
+    history.append(entry)
+    state.menu_history_bytes += entry["size"]
+    while len(history) > HISTORY_MAX_ENTRIES or (len(history) > 1 and state.menu_history_bytes > HISTORY_MAX_BYTES):
+        state.menu_history_bytes -= history.popleft()["size"]
+    state[f"{mode}_current"] = entry["id"]
+    return entry
+
+def find_history_entry(entry_id):
+    for entry in get_history():
+        if entry["id"] == entry_id:
+            return entry
+    return None
+
+def replace_history_menu(entry, i, menu):
+    entry["menus"][i] = menu
+    new_size = menus_size(entry["menus"])
+    st.session_state.menu_history_bytes += new_size - entry["size"]
+    entry["size"] = new_size
+
+def regenerate_menu(entry, i, slot):
+    prompt, generation = menu_request(entry["mode"], entry["params"], entry["tier"], count=1,
+                                      exclude=[menu_title(menu) for menu in entry["menus"]])
+    new_menu = None
+    menu_list = []
+    for menu_list in iter_menus(stream_gemini_api(prompt, generation)):
+        if menu_list:
+            new_menu = menu_list[0]
+            slot.markdown(menu_card_html(i, new_menu), unsafe_allow_html=True)
+    if is_error_result(menu_list):
+        slot.error(menu_list[-1].text)
+    elif new_menu is not None:
+        new_menu.detailed = entry["tier"] != "summary"
+        replace_history_menu(entry, i, new_menu)
+
+def show_history_result(mode):
+    entry = find_history_entry(st.session_state.get(f"{mode}_current"))
+    if entry is None:
+        return
+    st.markdown("<h3>🧑‍🍳 เมนูแนะนำ 3 เมนู:</h3>", unsafe_allow_html=True)
+    if entry["source"] == "similar":
+        st.caption("♻️ ใช้คำตอบจากคำขอที่ใกล้เคียงกันซึ่งเคยสร้างไว้แล้ว")
+    for i, col in enumerate(st.columns(3)[:len(entry["menus"])]):
+        slot = col.empty()
+        show_detail = (not entry["menus"][i].detailed
+                       and col.button("📖 ดูสูตรเต็ม", key=f"detail_{entry['id']}_{i}"))
+        if col.button("🔄 สร้างเมนูนี้ใหม่", key=f"regenerate_{entry['id']}_{i}"):
+            with col, st.spinner("กำลังสร้างเมนูใหม่..."):
+                regenerate_menu(entry, i, slot)
+        elif show_detail:
+            with col, st.spinner("กำลังโหลดสูตรเต็ม..."):
+                load_menu_detail(entry, i, slot)
+        else:
+            slot.markdown(menu_card_html(i, entry["menus"][i]), unsafe_allow_html=True)
+
+    entries = [item for item in get_history() if item["mode"] == mode]
+    if len(entries) > 1:
+        with st.expander("🕘 ประวัติและเปรียบเทียบเมนู"):
+            labels = {item["id"]: f"#{item['id']} {item['label']}" for item in entries}
+            entry_ids = list(labels)
+            selected = st.selectbox("แสดงผลลัพธ์ก่อนหน้า", entry_ids, index=entry_ids.index(entry["id"]),
+                                    format_func=labels.get, key=f"{mode}_history_select")
+            if selected != entry["id"]:
+                st.session_state[f"{mode}_current"] = selected
+                st.rerun()
+            compare_ids = st.multiselect("เปรียบเทียบผลลัพธ์", entry_ids, format_func=labels.get,
+                                         key=f"{mode}_history_compare")
+            if compare_ids:
+                st.table([dict({"ผลลัพธ์": labels[entry_id]},
+                               **{f"เมนูที่ {i+1}": menu_title(menu)
+                                  for i, menu in enumerate(find_history_entry(entry_id)["menus"])})
+                          for entry_id in compare_ids])
+
+# --- ตัวเลือกของแต่ละโหมด (tuple ของค่าคงที่ ถูกสร้างครั้งเดียวตอน compile ไม่ใช่ทุกครั้งที่ rerun) ---
+CREATE_CATEGORIES = (
+    "อาหารทั่วไป", "มังสวิรัติ", "อาหารคลีน", "อาหารไทย", "อาหารญี่ปุ่น", "อาหารตะวันตก", "อาหารจีน",
+    "อาหารอินเดีย", "อาหารเวียดนาม", "อาหารเกาหลี", "อาหารเม็กซิกัน", "อาหารอิตาเลียน", "อาหารฟาสต์ฟู้ด",
+    "อาหารทะเล", "อาหารเจ", "อาหารอีสาน", "อาหารใต้", "อาหารเหนือ", "อาหารฟิวชั่น", "ขนม", "เครื่องดื่ม",
+)
+CREATE_DIFFICULTIES = ("ง่าย", "ปานกลาง", "ยาก", "ยากมาก", "นรก")
+SEARCH_COUNTRIES = (
+    "ไทย", "ญี่ปุ่น", "เกาหลีใต้", "สหรัฐอเมริกา", "อังกฤษ", "ฝรั่งเศส", "เยอรมนี", "จีน", "อินเดีย",
+    "รัสเซีย", "แคนาดา", "บราซิล", "ออสเตรเลีย", "อาร์เจนตินา", "เม็กซิโก", "อิตาลี", "สเปน", "เนเธอร์แลนด์",
+    "สวิตเซอร์แลนด์", "เบลเยียม", "สวีเดน", "นอร์เวย์", "เดนมาร์ก", "ฟินแลนด์", "โปรตุเกส", "ออสเตรีย",
+    "ไอร์แลนด์", "กรีซ", "ตุรกี", "แอฟริกาใต้", "อียิปต์", "ไนจีเรีย", "เคนยา", "โมร็อกโก", "แอลจีเรีย",
+    "ซาอุดีอาระเบีย", "สหรัฐอาหรับเอมิเรตส์", "กาตาร์", "โอมาน", "คูเวต", "อิหร่าน", "อิรัก", "ปากีสถาน",
+    "บังกลาเทศ", "อินโดนีเซีย", "มาเลเซีย", "สิงคโปร์", "ฟิลิปปินส์", "เวียดนาม", "พม่า", "กัมพูชา", "ลาว",
+    "มองโกเลีย", "เกาหลีเหนือ", "ไต้หวัน", "ฮ่องกง", "มาเก๊า", "นิวซีแลนด์", "ฟิจิ", "ปาปัวนิวกินี",
+    "หมู่เกาะโซโลมอน", "วานูอาตู", "นาอูรู", "ตูวาลู", "คิริบาส", "ไมโครนีเซีย", "หมู่เกาะมาร์แชลล์", "ปาเลา",
+    "ซามัว", "ตองกา", "นีวเวย์", "หมู่เกาะคุก", "เฟรนช์โปลินีเซีย", "นิวแคลิโดเนีย", "วาลลิสและฟูตูนา",
+    "เฟรนช์เซาเทิร์นและแอนตาร์กติกแลนดส์", "เซนต์เฮเลนา", "อัสเซนชัน และตริสตันดากูนยา", "หมู่เกาะฟอล์กแลนด์",
+    "เซาท์จอร์เจียและหมู่เกาะเซาท์แซนด์วิช", "หมู่เกาะพิตแคร์น", "บริติชอินเดียนโอเชียนเทร์ริทอรี",
+    "หมู่เกาะบริติชเวอร์จิน", "หมู่เกาะเคย์แมน", "มอนต์เซอร์รัต", "แองกวิลลา", "อารูบา", "กูราเซา",
+    "ซินต์มาร์เติน", "โบแนร์", "เซนต์เอิสตาเชียสและเซนต์มาร์เติน", "กรีนแลนด์", "หมู่เกาะแฟโร", "ยิบรอลตาร์",
+    "อากรีอาและบาร์บูดา", "แอนติกาและบาร์บูดา", "บาร์เบโดส", "ดอมินิกา", "เกรนาดา", "เซนต์คิตส์และเนวิส",
+    "เซนต์ลูเซีย", "เซนต์วินเซนต์และเกรนาดีนส์", "ตรินิแดดและโตเบโก", "แองโกลา", "เบนิน", "บอตสวานา",
+    "บูร์กินาฟาโซ", "บุรุนดี", "กาบูเวร์ดี", "แคเมอรูน", "สาธารณรัฐแอฟริกากลาง", "ชาด", "สาธารณรัฐคองโก",
+    "สาธารณรัฐประชาธิปไตยคองโก", "โกตดิวัวร์", "จิบูตี", "อียิปต์", "อิเควทอเรียลกินี", "เอริเทรีย",
+    "เอสวาตินี", "เอธิโอเปีย", "กาบอง", "แกมเบีย", "กานา", "กินี", "กินี-บิสเซา", "เคนยา", "เลโซโท",
+    "ไลบีเรีย", "ลิเบีย", "มาดากัสการ์", "มาลาวี", "มาลี", "มอริเตเนีย", "มอริเชียส", "โมร็อกโก", "โมซัมบิก",
+    "นามิเบีย", "ไนเจอร์", "ไนจีเรีย", "รวันดา", "เซาตูเมและปรินซิปี", "เซเนกัล", "เซเชลส์", "เซียร์ราลีโอน",
+    "โซมาเลีย", "แอฟริกาใต้", "ซูดานใต้", "ซูดาน", "แทนซาเนีย", "โตโก", "ตูนิเซีย", "ยูกันดา", "แซมเบีย",
+    "ซิมบับเว",
+)
+SEARCH_CATEGORIES = (
+    "อาหารไทย", "อาหารญี่ปุ่น", "อาหารเกาหลี", "ฟาสต์ฟู้ด", "อาหารสุขภาพ", "อาหารจีน", "อาหารอินเดีย",
+    "อาหารเวียดนาม", "อาหารเม็กซิกัน", "อาหารอิตาเลียน", "อาหารทะเล", "อาหารเจ", "อาหารอีสาน", "อาหารใต้",
+    "อาหารเหนือ", "อาหารฟิวชั่น", "ขนม", "เครื่องดื่ม", "อาหารตะวันตก",
+)
+SEARCH_TASTES = (
+    "เผ็ด", "หวาน", "เค็ม", "เปรี้ยว", "ขม", "อูมามิ", "มัน", "ฝาด", "จืด", "รสจัด", "กลมกล่อม", "กลางๆ",
+)
+SEARCH_BUDGETS = (
+    "ต่ำกว่า 100 บาท", "100 - 300 บาท", "300 - 1000 บาท", "1000 - 10000 บาท", "ไม่จำกัดงบ(ระดับ MrBeast)",
+)
+UNLIMITED_BUDGET = "ไม่จำกัดงบ(ระดับ MrBeast)"
+
+def exclude_clause(exclude):
+    return f"โดยต้องไม่ซ้ำกับเมนูเหล่านี้: {', '.join(exclude)} " if exclude else ""
+
+def build_search_prompt(country, category, taste, budget, count=3, exclude=()):
+    if budget == UNLIMITED_BUDGET:
+        return (f"ฉันต้องการซื้ออาหาร {category} รสชาติ {taste} ราคา 10000 - 10000000 บาท {budget} "
+                f"ที่มีขายใน {country} แนะนำ {count} ตัวเลือกเมนู {category} ที่มีขายใน {country} "
+                f"{exclude_clause(exclude)}"
+                f"บอกราคาของอาหารด้วย และบอกว่าหาซื้อได้ที่ร้านไหน {menu_json_format(count)}")
+    return (f"ฉันต้องการซื้ออาหาร {category} รสชาติ {taste} ราคา {budget} "
+            f"ที่มีขายใน {country} แนะนำ {count} ตัวเลือกเมนู {category} ที่มีขายใน {country} "
+            f"{exclude_clause(exclude)}"
+            f"บอกราคาของอาหารด้วย และบอกว่าหาซื้อได้ที่ร้านไหน {menu_json_format(count)}")
+
+# --- Menu Catalog: คำตอบที่สร้างไว้ล่วงหน้าสำหรับชุดตัวเลือกยอดนิยมของโหมดค้นหา ---
+CATALOG_DB_FILE = "menu_catalog.db"
+CATALOG_TTL = 7 * 24 * 60 * 60  # วินาทีก่อนรายการใน catalog ถือว่าเก่าและต้องสร้างใหม่เบื้องหลัง
+CATALOG_WARMUP_SIZE = 50  # จำนวนชุดตัวเลือกยอดนิยมที่สร้างไว้ล่วงหน้าเมื่อไม่ระบุ
+ERROR_PREFIXES = ("❌", "⚠️", "🚦", "⏳", "✂️")  # ตัวขึ้นต้นของ StreamError แต่ละชนิด ใช้แยกประเภทผลใน load test
+
+def combo_key(combo):
+    return "|".join(combo)
+
+class MenuCatalog:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS catalog "
+                     "(combo TEXT PRIMARY KEY, menus TEXT NOT NULL, created_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS search_log (combo TEXT PRIMARY KEY, searches INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS search_log_searches ON search_log (searches)")
+        conn.execute("CREATE TABLE IF NOT EXISTS search_transitions (field INTEGER NOT NULL, "
+                     "from_value TEXT NOT NULL, to_value TEXT NOT NULL, count INTEGER NOT NULL, "
+                     "PRIMARY KEY (field, from_value, to_value))")
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def get(self, combo):
+        row = self._connect().execute("SELECT menus, created_at FROM catalog WHERE combo = ?",
+                                      (combo_key(combo),)).fetchone()
+        if row is None:
+            return None
+        return [Menu.from_dict(menu) for menu in json.loads(row[0])], time.time() - row[1] > CATALOG_TTL
+
+    def lookup(self, combo):
+        conn = self._connect()
+        conn.execute("INSERT INTO search_log (combo, searches) VALUES (?, 1) "
+                     "ON CONFLICT(combo) DO UPDATE SET searches = searches + 1", (combo_key(combo),))
+        entry = self.get(combo)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            elif entry[1]:
+                self.stale_hits += 1
+            else:
+                self.fresh_hits += 1
+        return entry
+
+    def store(self, combo, menu_list):
+        self._connect().execute("INSERT OR REPLACE INTO catalog (combo, menus, created_at) VALUES (?, ?, ?)",
+                                (combo_key(combo), json.dumps([menu.to_dict() for menu in menu_list],
+                                                              ensure_ascii=False), time.time()))
+
+    def popular(self, limit):
+        rows = self._connect().execute("SELECT combo FROM search_log ORDER BY searches DESC LIMIT ?",
+                                       (limit,)).fetchall()
+        return [tuple(row[0].split("|")) for row in rows]
+
+    def record_transition(self, previous, combo):
+        # เรียนรู้เฉพาะการค้นหาซ้ำที่เปลี่ยนตัวเลือกเพียงช่องเดียว ซึ่งเป็นรูปแบบที่ผู้ใช้ทำบ่อยที่สุด
+        changed = [field for field, (old, new) in enumerate(zip(previous, combo)) if old != new]
+        if len(changed) != 1:
+            return
+        field = changed[0]
+        self._connect().execute("INSERT INTO search_transitions (field, from_value, to_value, count) "
+                                "VALUES (?, ?, ?, 1) ON CONFLICT(field, from_value, to_value) "
+                                "DO UPDATE SET count = count + 1", (field, previous[field], combo[field]))
+
+    def transitions(self, combo):
+        # {(ช่อง, ค่าใหม่): จำนวนครั้ง} ของการเปลี่ยนจากค่าปัจจุบันในแต่ละช่อง
+        rows = self._connect().execute(
+            "SELECT field, to_value, count FROM search_transitions WHERE "
+            + " OR ".join("(field = ? AND from_value = ?)" for _ in combo),
+            [param for field, value in enumerate(combo) for param in (field, value)]).fetchall()
+        return {(field, to_value): count for field, to_value, count in rows}
+
+    def stats(self):
+        conn = self._connect()
+        entries = conn.execute("SELECT COUNT(*) FROM catalog").fetchone()[0]
+        stale = conn.execute("SELECT COUNT(*) FROM catalog WHERE created_at < ?",
+                             (time.time() - CATALOG_TTL,)).fetchone()[0]
+        searches, covered = conn.execute(
+            "SELECT COALESCE(SUM(searches), 0), COALESCE(SUM(CASE WHEN combo IN (SELECT combo FROM catalog) "
+            "THEN searches ELSE 0 END), 0) FROM search_log").fetchone()
+        total_combos = (len(set(SEARCH_COUNTRIES)) * len(SEARCH_CATEGORIES)
+                        * len(SEARCH_TASTES) * len(SEARCH_BUDGETS))
+        with self.lock:
+            lookups = self.fresh_hits + self.stale_hits + self.misses
+            return {
+                "entries": entries,
+                "stale": stale,
+                "coverage": entries / total_combos,
+                "search_coverage": covered / searches if searches else 0.0,
+                "fresh_hits": self.fresh_hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_rate": (self.fresh_hits + self.stale_hits) / lookups if lookups else 0.0,
+            }
+
+@st.cache_resource
+def get_menu_catalog():
+    return MenuCatalog(CATALOG_DB_FILE)
+
+def refresh_catalog_entry(combo, expired=False):
+    catalog = get_menu_catalog()
+    try:
+        if expired:
+            return False
+        # เรียกผ่าน key pool โดยตรง เพราะฟังก์ชันนี้อาจทำงานอยู่ใน worker pool อยู่แล้ว
+        cache = get_response_cache()
+        prompt = build_search_prompt(*combo)
+        generation = ("search", "full")
+        chunks = list(stream_from_key_pool(prompt, cache, response_key(prompt, generation), generation))
+        response_text = "".join(chunks).strip()
+        # เก็บเฉพาะเมื่อการเรียกจบครบ คำตอบที่ขาดกลางทางจะไม่ทับรายการเดิมใน catalog
+        if not response_text or stream_failed(chunks):
+            return False
+        catalog.store(combo, parse_menus(response_text))
+        return True
+    finally:
+        with catalog.lock:
+            catalog.refreshing.discard(combo)
+
+def schedule_catalog_refresh(combo):
+    catalog = get_menu_catalog()
+    with catalog.lock:
+        if combo in catalog.refreshing:
+            return
+        catalog.refreshing.add(combo)
+    if not get_worker_pool().submit(refresh_catalog_entry, combo):
+        with catalog.lock:
+            catalog.refreshing.discard(combo)
+
+def popular_search_combos(limit):
+    # ชุดที่ถูกค้นหาบ่อยที่สุดก่อน แล้วเติมด้วยชุดที่อยู่ต้นรายการตัวเลือก (ค่าเริ่มต้นของหน้าจอ)
+    combos = list(dict.fromkeys(get_menu_catalog().popular(limit)))
+    if len(combos) < limit:
+        indexed = itertools.product(*(enumerate(dict.fromkeys(options)) for options in
+                                      (SEARCH_COUNTRIES, SEARCH_CATEGORIES, SEARCH_TASTES, SEARCH_BUDGETS)))
+        for ranked in heapq.nsmallest(limit, indexed, key=lambda ranked: sum(i for i, _ in ranked)):
+            combo = tuple(value for _, value in ranked)
+            if combo not in combos:
+                combos.append(combo)
+    return combos[:limit]
+
+def format_catalog_report(stats):
+    return (f"Catalog entries: {stats['entries']} (stale {stats['stale']}) | "
+            f"Coverage: {stats['coverage']:.3%} of all combinations, {stats['search_coverage']:.0%} of searches | "
+            f"Hits: {stats['fresh_hits']} fresh, {stats['stale_hits']} stale | Misses: {stats['misses']} | "
+            f"Hit rate: {stats['hit_rate']:.0%}")
+
+def warm_up_catalog(limit):
+    catalog = get_menu_catalog()
+    combos = popular_search_combos(limit)
+    for n, combo in enumerate(combos, 1):
+        entry = catalog.get(combo)
+        if entry is not None and not entry[1]:
+            status = "skip"
+        else:
+            status = "ok" if refresh_catalog_entry(combo) else "failed"
+        print(f"[{n}/{len(combos)}] {status}: {' / '.join(combo)}")
+    print(format_catalog_report(catalog.stats()))
+
+# --- Prefetch: สร้างคำตอบของชุดตัวเลือกข้างเคียงที่ผู้ใช้น่าจะค้นหาต่อ ไว้ใน Response Cache ระหว่างที่ผู้ใช้กำลังอ่านผล ---
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "0") == "1"  # ปิดไว้เป็นค่าเริ่มต้นเพราะใช้โควต้าเพิ่ม
+PREFETCH_CANDIDATES = 3  # จำนวนชุดตัวเลือกข้างเคียงที่ลองสร้างล่วงหน้าต่อหนึ่งผลลัพธ์
+PREFETCH_MAX_CONCURRENT = 2  # จำนวนการเรียก API เพื่อ prefetch พร้อมกันสูงสุดทั้ง process
+PREFETCH_KEY_BUDGET = 20  # จำนวนการเรียกเพื่อ prefetch สูงสุดต่อ key ในแต่ละช่วงเวลา
+PREFETCH_BUDGET_WINDOW = 60 * 60  # วินาที
+PREFETCH_FIELD_PRIORS = (0.0, 0.0, 1.0, 1.0)  # น้ำหนักเริ่มต้นของการเปลี่ยน ประเทศ/ประเภท/รสชาติ/งบ ก่อนมีข้อมูล
+
+class Prefetcher:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.running = 0
+        self.pending = set()
+        self.ready = {}  # ชุดตัวเลือก -> เวลาที่ prefetch เสร็จ ยังไม่มีผู้ใช้ค้นหา
+        self.key_calls = {}  # index ของ key -> deque เวลาที่เรียกเพื่อ prefetch
+        self.issued = 0
+        self.completed = 0
+        self.failed = 0
+        self.hits = 0
+        self.wasted = 0
+        self.skipped_budget = 0
+
+    def candidates(self, combo, limit):
+        counts = get_menu_catalog().transitions(combo)
+        scored = []
+        for field, options in enumerate((SEARCH_COUNTRIES, SEARCH_CATEGORIES, SEARCH_TASTES, SEARCH_BUDGETS)):
+            values = list(dict.fromkeys(options))
+            if combo[field] not in values:
+                continue
+            current = values.index(combo[field])
+            for i, value in enumerate(values):
+                if i == current:
+                    continue
+                # การเปลี่ยนที่เคยเกิดจริงมาก่อน ที่เหลือเรียงตามระยะห่างจากตัวเลือกเดิมบนหน้าจอ
+                score = counts.get((field, value), 0) + PREFETCH_FIELD_PRIORS[field] / abs(i - current)
+                if score > 0:
+                    scored.append((score, combo[:field] + (value,) + combo[field + 1:]))
+        return [neighbor for _, neighbor in heapq.nlargest(limit, scored, key=lambda item: item[0])]
+
+    def _over_budget_keys(self):
+        cutoff = time.time() - PREFETCH_BUDGET_WINDOW
+        over_budget = set()
+        with self.lock:
+            for index, calls in self.key_calls.items():
+                while calls and calls[0] < cutoff:
+                    calls.popleft()
+                if len(calls) >= PREFETCH_KEY_BUDGET:
+                    over_budget.add(index)
+        return over_budget
+
+    def _charge(self, key_state):
+        with self.lock:
+            self.key_calls.setdefault(key_state.index, deque()).append(time.time())
+
+    def _expire(self):
+        # คำตอบที่ prefetch ไว้แล้วหมดอายุใน cache โดยไม่มีใครค้นหา ถือเป็นการเรียกที่สูญเปล่า
+        cutoff = time.time() - CACHE_TTL
+        with self.lock:
+            for combo in [combo for combo, finished_at in self.ready.items() if finished_at < cutoff]:
+                del self.ready[combo]
+                self.wasted += 1
+                get_metrics().incr("prefetch_results", outcome="wasted")
+
+    def claim(self, combo):
+        with self.lock:
+            if self.ready.pop(combo, None) is None:
+                return False
+            self.hits += 1
+        get_metrics().incr("prefetch_results", outcome="hit")
+        return True
+
+    def schedule(self, combo):
+        cache = get_response_cache()
+        if not self.enabled or cache.bypass:
+            return
+        self._expire()
+        # ทำเฉพาะตอนที่ไม่มีคำขอของผู้ใช้รอคิวอยู่ เพื่อไม่ให้ prefetch แย่ง worker จากผู้ใช้จริง
+        if get_worker_pool().stats()["queued"]:
+            return
+        catalog = get_menu_catalog()
+        flights = get_single_flight()
+        for neighbor in self.candidates(combo, PREFETCH_CANDIDATES):
+            with self.lock:
+                if self.running >= PREFETCH_MAX_CONCURRENT:
+                    return
+                if neighbor in self.pending or neighbor in self.ready:
+                    continue
+                # จองช่องใน critical section เดียวกับที่ตรวจเพดาน ไม่อย่างนั้นหลาย session ที่ schedule พร้อมกัน
+                # จะผ่านการตรวจไปด้วยกันทั้งหมดแล้วเรียก API เกิน PREFETCH_MAX_CONCURRENT
+                self.running += 1
+                self.pending.add(neighbor)
+            started = None
+            try:
+                started = self._start(neighbor, cache, catalog, flights)
+            finally:
+                if not started:
+                    with self.lock:
+                        self.running -= 1
+                        self.pending.discard(neighbor)
+            if started is None:
+                return
+
+    def _start(self, neighbor, cache, catalog, flights):
+        # True = ส่งงานแล้ว, False = ข้ามชุดนี้ไปชุดถัดไป, None = หยุด schedule รอบนี้
+        exclude = self._over_budget_keys()
+        if len(exclude) >= len(API_KEYS):
+            with self.lock:
+                self.skipped_budget += 1
+            return None
+        entry = catalog.get(neighbor)
+        if entry is not None and not entry[1]:
+            return False
+        prompt, generation = menu_request("search", neighbor, GENERATION_TIER)
+        cache_key = response_key(prompt, generation)
+        if cache.contains(cache_key):
+            return False
+        # ใช้ single-flight เดียวกับผู้ใช้ ถ้าผู้ใช้กดค้นหาชุดนี้ระหว่าง prefetch จะรับคำตอบจากการเรียกครั้งนี้
+        flight = flights.lead(cache_key)
+        if flight is None:
+            return False
+        with self.lock:
+            self.issued += 1
+        if not get_worker_pool().submit(self._run, neighbor, prompt, cache, cache_key, flight, generation, exclude):
+            flights.publish(flight, BUSY_MESSAGE)
+            flights.finish(cache_key, flight)
+            with self.lock:
+                self.issued -= 1
+            return None
+        return True
+
+    def _run(self, combo, prompt, cache, cache_key, flight, generation, exclude, expired=False):
+        succeeded = False
+        try:
+            run_flight(prompt, cache, cache_key, flight, generation, exclude, self._charge, expired=expired)
+            succeeded = not expired and cache.contains(cache_key)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.pending.discard(combo)
+                if succeeded:
+                    self.completed += 1
+                    self.ready[combo] = time.time()
+                else:
+                    self.failed += 1
+            get_metrics().incr("prefetch_calls", outcome="ok" if succeeded else "failed")
+
+    def stats(self):
+        self._expire()
+        with self.lock:
+            return {"running": self.running, "issued": self.issued, "completed": self.completed,
+                    "failed": self.failed, "hits": self.hits, "wasted": self.wasted, "unused": len(self.ready),
+                    "skipped_budget": self.skipped_budget,
+                    "hit_rate": self.hits / self.completed if self.completed else 0.0}
+
+@st.cache_resource
+def get_prefetcher():
+    return Prefetcher(PREFETCH_ENABLED)
+
+# --- วัตถุดิบ: ทำให้อยู่ในรูปมาตรฐาน และค้นหาคำขอเก่าที่ใกล้เคียงกันเพื่อใช้คำตอบซ้ำ ---
+INGREDIENT_SPLIT_PATTERN = re.compile(r"[,，、;\n]+")
+INGREDIENT_SYNONYMS = {
+    "egg": "ไข่", "eggs": "ไข่", "ไข่ไก่": "ไข่",
+    "pork": "หมู", "เนื้อหมู": "หมู", "minced pork": "หมูสับ", "ground pork": "หมูสับ", "หมูบด": "หมูสับ",
+    "chicken": "ไก่", "เนื้อไก่": "ไก่", "chicken breast": "อกไก่",
+    "beef": "เนื้อวัว", "เนื้อ": "เนื้อวัว",
+    "shrimp": "กุ้ง", "prawn": "กุ้ง", "prawns": "กุ้ง", "กุ้งสด": "กุ้ง",
+    "squid": "ปลาหมึก", "หมึก": "ปลาหมึก", "fish": "ปลา",
+    "tofu": "เต้าหู้", "rice": "ข้าว", "ข้าวสวย": "ข้าว", "noodles": "เส้นก๋วยเตี๋ยว",
+    "garlic": "กระเทียม", "onion": "หอมใหญ่", "หัวหอม": "หอมใหญ่", "shallot": "หอมแดง",
+    "chili": "พริก", "chilli": "พริก", "พริกขี้หนู": "พริก",
+    "basil": "ใบกะเพรา", "holy basil": "ใบกะเพรา", "กะเพรา": "ใบกะเพรา",
+    "cabbage": "กะหล่ำปลี", "กะหล่ำ": "กะหล่ำปลี", "chinese cabbage": "ผักกาดขาว",
+    "tomato": "มะเขือเทศ", "tomatoes": "มะเขือเทศ", "carrot": "แครอท", "potato": "มันฝรั่ง",
+    "mushroom": "เห็ด", "mushrooms": "เห็ด", "milk": "นม", "cheese": "ชีส",
+}
+SIMILAR_DB_FILE = "similar_requests.db"
+SIMILAR_MIN_JACCARD = 0.8  # สัดส่วนวัตถุดิบที่ตรงกัน (Jaccard) ขั้นต่ำที่ถือว่าคำขอใกล้เคียงกัน
+SIMILAR_CALORIES_TOLERANCE = 100  # kcal ที่ต่างกันได้
+SIMILAR_COOK_TIME_TOLERANCE = 10  # นาทีที่ต่างกันได้
+SIMILAR_TTL = CACHE_TTL
+SIMILAR_MAX_CANDIDATES = 200
+
+def canonicalize_ingredients(ingredients):
+    canonical = set()
+    for name in INGREDIENT_SPLIT_PATTERN.split(ingredients):
+        name = " ".join(name.split()).lower()
+        if name:
+            canonical.add(INGREDIENT_SYNONYMS.get(name, name))
+    return tuple(sorted(canonical))
+
+class SimilarRequestIndex:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS similar_requests "
+                     "(id INTEGER PRIMARY KEY, category TEXT NOT NULL, difficulty TEXT NOT NULL, "
+                     "calories INTEGER NOT NULL, cook_time INTEGER NOT NULL, ingredients TEXT NOT NULL, "
+                     "response TEXT NOT NULL, created_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS similar_requests_lookup "
+                     "ON similar_requests (category, difficulty, calories)")
+        try:
+            # คำตอบแบบสรุปกับแบบเต็มใช้แทนกันไม่ได้ (ฐานข้อมูลเดิมไม่มีคอลัมน์นี้ ถือว่าเป็นแบบเต็มทั้งหมด)
+            conn.execute("ALTER TABLE similar_requests ADD COLUMN tier TEXT NOT NULL DEFAULT 'full'")
+        except sqlite3.OperationalError:
+            pass  # มีคอลัมน์อยู่แล้ว
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def find(self, ingredients, category, calories, difficulty, cook_time, tier):
+        # กรองด้วย index ตามประเภท ความยาก และช่วงแคลอรี่ก่อน แล้วค่อยเทียบชุดวัตถุดิบ
+        rows = self._connect().execute(
+            "SELECT ingredients, response FROM similar_requests WHERE category = ? AND difficulty = ? "
+            "AND calories BETWEEN ? AND ? AND cook_time BETWEEN ? AND ? AND created_at >= ? AND tier = ? "
+            "ORDER BY created_at DESC LIMIT ?",
+            (category, difficulty, calories - SIMILAR_CALORIES_TOLERANCE, calories + SIMILAR_CALORIES_TOLERANCE,
+             cook_time - SIMILAR_COOK_TIME_TOLERANCE, cook_time + SIMILAR_COOK_TIME_TOLERANCE,
+             time.time() - SIMILAR_TTL, tier, SIMILAR_MAX_CANDIDATES)).fetchall()
+        wanted = set(ingredients)
+        best_score, best_response = 0.0, None
+        for stored, response in rows:
+            stored = set(json.loads(stored))
+            score = len(wanted & stored) / len(wanted | stored)
+            if score > best_score:
+                best_score, best_response = score, response
+        with self.lock:
+            if best_score >= SIMILAR_MIN_JACCARD:
+                self.hits += 1
+                return best_response
+            self.misses += 1
+        return None
+
+    def add(self, ingredients, category, calories, difficulty, cook_time, tier, response_text):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("INSERT INTO similar_requests (category, difficulty, calories, cook_time, ingredients, "
+                     "response, tier, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (category, difficulty, calories, cook_time, json.dumps(list(ingredients), ensure_ascii=False),
+                      response_text, tier, now))
+        conn.execute("DELETE FROM similar_requests WHERE created_at < ?", (now - SIMILAR_TTL,))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+@st.cache_resource
+def get_similar_index():
+    return SimilarRequestIndex(SIMILAR_DB_FILE)
+
+def remember_response(chunks, on_complete):
+    received = []
+    for chunk in chunks:
+        received.append(chunk)
+        yield chunk
+    response_text = "".join(received).strip()
+    # ข้อผิดพลาดอาจมาหลังคำตอบบางส่วนแล้ว จึงดูจากชนิดของ chunk แทนตัวขึ้นต้นของข้อความ
+    if response_text and not stream_failed(received):
+        on_complete(response_text)
+
+def build_create_prompt(ingredients, category, calories, difficulty, cook_time, count=3, exclude=()):
+    return (f"ฉันมี: {', '.join(ingredients)} เป็นวัตถุดิบหลัก "
+            f"แนะนำเมนู {category} เวลาทำไม่เกิน {cook_time} นาที "
+            f"ประมาณ {calories} kcal ระดับความยาก {difficulty} "
+            f"พร้อมวิธีทำอย่างละเอียด เสนอ {count} ตัวเลือก {exclude_clause(exclude)}"
+            f"ถ้าวัตถุดิบที่มีขาดอะไรไปให้บอกด้วย และบอกจำนวนที่ต้องใช้อย่างละเอียด "
+            f"{menu_json_format(count)}")
+
+# --- Tiered generation: ขอชื่อเมนูและจุดเด่นแบบสั้นก่อน แล้วค่อยโหลดสูตรเต็มเฉพาะการ์ดที่ผู้ใช้กดดู ---
+# ปิดไว้ก่อนจนกว่าจะวัดขนาดคำตอบจริงของแต่ละระดับและปรับ GENERATION_CONFIGS แล้ว
+TIERED_GENERATION = os.environ.get("TIERED_GENERATION", "0") == "1"  # "1" = ขอแบบสรุปก่อน แล้วโหลดสูตรเต็มเมื่อกดดู
+GENERATION_TIER = "summary" if TIERED_GENERATION else "full"
+
+def build_create_summary_prompt(ingredients, category, calories, difficulty, cook_time, count=3, exclude=()):
+    return (f"วัตถุดิบหลัก: {', '.join(ingredients)} | {category} | ไม่เกิน {cook_time} นาที | "
+            f"ประมาณ {calories} kcal | ความยาก {difficulty} เสนอ {count} เมนู {exclude_clause(exclude)}"
+            f"ไม่ต้องมีวิธีทำ {menu_json_format(count, MENU_SUMMARY_SCHEMA)}")
+
+def build_search_summary_prompt(country, category, taste, budget, count=3, exclude=()):
+    price = "10000 - 10000000 บาท" if budget == UNLIMITED_BUDGET else budget
+    return (f"เมนู{category}ที่มีขายใน {country} รสชาติ {taste} ราคา {price} เสนอ {count} เมนู "
+            f"{exclude_clause(exclude)}{menu_json_format(count, MENU_SUMMARY_SCHEMA)}")
+
+def build_detail_prompt(mode, params, menu):
+    if mode == "create":
+        ingredients, category, calories, difficulty, cook_time = params
+        return (f"ขอสูตรเมนู {menu.name} ({category}) จากวัตถุดิบหลัก {', '.join(ingredients)} "
+                f"เวลาทำไม่เกิน {cook_time} นาที ประมาณ {calories} kcal ระดับความยาก {difficulty} "
+                f"พร้อมวิธีทำอย่างละเอียด ถ้าวัตถุดิบที่มีขาดอะไรไปให้บอกด้วย และบอกจำนวนที่ต้องใช้อย่างละเอียด "
+                f"{menu_json_format(1)}")
+    country, category, taste, budget = params
+    return (f"ขอรายละเอียดเมนู {menu.name} ({category} รสชาติ {taste} ที่มีขายใน {country} งบ {budget}) "
+            f"บอกวัตถุดิบหลัก ราคา และร้านที่หาซื้อได้ {menu_json_format(1)}")
+
+MENU_PROMPT_BUILDERS = {
+    ("create", "full"): build_create_prompt,
+    ("create", "summary"): build_create_summary_prompt,
+    ("search", "full"): build_search_prompt,
+    ("search", "summary"): build_search_summary_prompt,
+}
+
+def menu_request(mode, params, tier, count=3, exclude=()):
+    return MENU_PROMPT_BUILDERS[(mode, tier)](*params, count=count, exclude=exclude), (mode, tier)
+
+def load_menu_detail(entry, i, slot):
+    summary_menu = entry["menus"][i]
+    generation = (entry["mode"], "detail")
+    detail = None
+    menu_list = []
+    with span("request_seconds", mode=entry["mode"], source="live", tier="detail"):
+        for menu_list in iter_menus(stream_gemini_api(build_detail_prompt(entry["mode"], entry["params"],
+                                                                          summary_menu), generation)):
+            if menu_list:
+                detail = menu_list[0]
+                slot.markdown(menu_card_html(i, detail), unsafe_allow_html=True)
+    if is_error_result(menu_list):
+        slot.error(menu_list[-1].text)
+    elif detail is not None:
+        detail.name = detail.name or summary_menu.name
+        detail.summary = summary_menu.summary
+        replace_history_menu(entry, i, detail)
+
+# --- Load test: ยิงคำขอของทั้งสองโหมดพร้อมกันผ่านเส้นทางเดียวกับหน้าเว็บ (single-flight, worker pool, key pool) ---
+LOADTEST_REQUESTS = 50  # จำนวนคำขอต่อโหมดเมื่อไม่ระบุ
+LOADTEST_CONCURRENCY = 8  # จำนวนผู้ใช้จำลองที่ส่งคำขอพร้อมกันเมื่อไม่ระบุ
+LOADTEST_INGREDIENTS = (
+    ("ไข่", "หมูสับ"), ("ไก่", "กระเทียม", "พริก"), ("กุ้ง", "เส้นหมี่"),
+    ("เต้าหู้", "ผักกาด"), ("ปลา", "มะนาว", "ตะไคร้"),
+)
+LOADTEST_OUTCOMES = dict(zip(ERROR_PREFIXES, ("error", "quota_exhausted", "rejected", "timeout", "truncated")))
+
+def load_test_requests(mode, n):
+    rng = random.Random(n)  # ชุดคำขอเดิมทุกครั้งที่รันด้วยจำนวนเท่าเดิม
+    if mode == "search":
+        combos = popular_search_combos(n)
+        return [menu_request("search", combos[i % len(combos)], GENERATION_TIER) for i in range(n)]
+    return [menu_request("create", (list(rng.choice(LOADTEST_INGREDIENTS)), rng.choice(CREATE_CATEGORIES),
+                                    rng.randrange(100, 1501, 50), rng.choice(CREATE_DIFFICULTIES),
+                                    rng.randrange(5, 181, 5)), GENERATION_TIER)
+            for _ in range(n)]
+
+def load_test_request(request):
+    prompt, generation = request
+    started = time.perf_counter()
+    first_chunk = None
+    received = []
+    for chunk in stream_gemini_api(prompt, generation):
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - started
+        received.append(chunk)
+    errors = [chunk for chunk in received if isinstance(chunk, StreamError)]
+    if errors:
+        outcome = next((LOADTEST_OUTCOMES[prefix] for prefix in ERROR_PREFIXES if errors[-1].startswith(prefix)),
+                       "error")
+    else:
+        outcome = "ok" if "".join(received).strip() else "empty"
+    return time.perf_counter() - started, first_chunk or 0.0, outcome
+
+def counter_totals(metric, label):
+    # รวม counter ตามค่าของ label เดียว เช่น gemini_calls ตาม outcome
+    metrics = get_metrics()
+    totals = {}
+    with metrics.lock:
+        for (name, labels), value in metrics.counters.items():
+            if name == metric:
+                key = dict(labels)[label]
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+def run_load_test(n, concurrency):
+    # ปิด response cache ระหว่างทดสอบ ไม่อย่างนั้นรอบที่สองจะตอบจาก cache ทั้งหมดและไม่ได้วัดอะไรเลย
+    get_response_cache().bypass = True
+    print(f"Backend: {MODEL_BACKEND} | Tier: {GENERATION_TIER} | Keys: {len(API_KEYS)} | "
+          f"Workers: {MAX_UPSTREAM_CALLS} | Concurrency: {concurrency}")
+    for mode in ("search", "create"):
+        requests = load_test_requests(mode, n)
+        calls_before = counter_totals("gemini_calls", "outcome")
+        tokens_before = counter_totals("gemini_tokens", "kind")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(load_test_request, requests))
+        elapsed = time.perf_counter() - started
+        calls_after = counter_totals("gemini_calls", "outcome")
+        tokens_after = counter_totals("gemini_tokens", "kind")
+        latencies = sorted(latency for latency, _, _ in results)
+        first_chunks = sorted(first_chunk for _, first_chunk, _ in results)
+        outcomes = {}
+        for _, _, outcome in results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        calls = {outcome: calls_after[outcome] - calls_before.get(outcome, 0) for outcome in calls_after}
+        tokens = {kind: tokens_after[kind] - tokens_before.get(kind, 0) for kind in tokens_after}
+        print(f"[{mode}] {len(results)} requests in {elapsed:.1f}s = {len(results) / elapsed:.2f} req/s")
+        print(f"  latency p50/p95/p99: {percentile(latencies, 0.5):.2f}/{percentile(latencies, 0.95):.2f}/"
+              f"{percentile(latencies, 0.99):.2f}s | first chunk p50/p95: {percentile(first_chunks, 0.5):.2f}/"
+              f"{percentile(first_chunks, 0.95):.2f}s")
+        print(f"  outcomes: {', '.join(f'{k}={v}' for k, v in sorted(outcomes.items()))}")
+        print(f"  API calls: {sum(calls.values())} ({', '.join(f'{k}={v}' for k, v in sorted(calls.items()))}) | "
+              f"tokens: {', '.join(f'{k}={v}' for k, v in sorted(tokens.items())) or '-'}")
+    print("Key pool:")
+    for row in get_key_pool().stats():
+        print(f"  {row['key']}: requests={row['requests']} quota_errors={row['quota_errors']} "
+              f"errors={row['errors']} latency={row['latency_s']}s cooldown={row['cooldown_s']}s")
+
+# --- Command line: python app.py --warmup [จำนวนชุดตัวเลือก] | --loadtest [คำขอต่อโหมด] [จำนวนพร้อมกัน] ---
+if __name__ == "__main__" and "--warmup" in sys.argv:
+    warmup_args = sys.argv[sys.argv.index("--warmup") + 1:]
+    warm_up_catalog(int(warmup_args[0]) if warmup_args else CATALOG_WARMUP_SIZE)
+    sys.exit(0)
+if __name__ == "__main__" and "--loadtest" in sys.argv:
+    loadtest_args = sys.argv[sys.argv.index("--loadtest") + 1:]
+    run_load_test(int(loadtest_args[0]) if loadtest_args else LOADTEST_REQUESTS,
+                  int(loadtest_args[1]) if len(loadtest_args) > 1 else LOADTEST_CONCURRENCY)
+    sys.exit(0)
 
 # --- Custom CSS สำหรับโทนสีเขียวและดีไซน์ที่ทันสมัย ---
-st.markdown("""
+with span("stage_seconds", stage="render_css"):
+    st.markdown("""
 <style>
 @import url('https://fonts.googleapis.com/css2?family=Kanit:wght@300;400;600&display=swap');
 body {
@@ -193,9 +2165,7 @@ body {
 """, unsafe_allow_html=True)
 
 # --- Update Visitor Count และ Active Users ---
-visitor_count = increment_visitor_count()
-update_active_user()
-active_users = get_active_users()
+visitor_count, active_users = track_presence()
 
 # --- Header Section ---
 st.markdown(f"""
@@ -219,41 +2189,43 @@ def create_menu_mode():
     with st.expander("⚙️ ปรับแต่งเมนู", expanded=True):
         col1, col2 = st.columns(2)
         with col1:
-            category = st.selectbox("ประเภทอาหาร",
-                                    ["อาหารทั่วไป", "มังสวิรัติ", "อาหารคลีน", "อาหารไทย", "อาหารญี่ปุ่น",
-                                     "อาหารตะวันตก", "อาหารจีน", "อาหารอินเดีย", "อาหารเวียดนาม", "อาหารเกาหลี",
-                                     "อาหารเม็กซิกัน", "อาหารอิตาเลียน", "อาหารฟาสต์ฟู้ด", "อาหารทะเล",
-                                     "อาหารเจ", "อาหารอีสาน", "อาหารใต้", "อาหารเหนือ", "อาหารฟิวชั่น", "ขนม", "เครื่องดื่ม"])
+            category = st.selectbox("ประเภทอาหาร", CREATE_CATEGORIES)
             calories = st.slider("แคลอรี่ที่ต้องการ (kcal)", 100, 1500, 500, step=50)
         with col2:
-            difficulty = st.radio("ระดับความยาก", ["ง่าย", "ปานกลาง", "ยาก", "ยากมาก", "นรก"], horizontal=True)
+            difficulty = st.radio("ระดับความยาก", CREATE_DIFFICULTIES, horizontal=True)
             cook_time = st.slider("เวลาทำอาหาร (นาที)", 5, 180, 30, step=5)
     
-    if st.button("🍳 สร้างเมนู", key="create_menu"):
-        if ingredients.strip():
-            prompt = (f"ฉันมี: {ingredients} เป็นวัตถุดิบหลัก "
-                      f"แนะนำเมนู {category} เวลาทำไม่เกิน {cook_time} นาที "
-                      f"ประมาณ {calories} kcal ระดับความยาก {difficulty} "
-                      f"พร้อมวิธีทำอย่างละเอียด เสนอ 3 ตัวเลือก คั่นด้วย '🍽️ เมนูที่' "
-                      f"ไม่ต้องเกริ่นนำ ถ้าวัตถุดิบที่มีขาดอะไรไปให้บอกด้วย และบอกจำนวนที่ต้องใช้อย่างละเอียด")
-            with st.spinner("กำลังสร้างสรรค์ไอเดียอร่อยๆ..."):
-                menu_list = process_menus(call_gemini_api(prompt))
-            if menu_list:
-                st.markdown("<h3>🧑‍🍳 เมนูแนะนำ 3 เมนู:</h3>", unsafe_allow_html=True)
-                cols = st.columns(3)
-                for i, menu in enumerate(menu_list[:3]):
-                    with cols[i]:
-                        menu = format_menu_text(menu)
-                        st.markdown(f"""
-                        <div class="menu-column">
-                            <h4>🍽️ เมนูที่ {i+1}</h4>
-                            <p>{menu}</p>
-                        </div>
-                        """, unsafe_allow_html=True)
+    clicked = st.button("🍳 สร้างเมนู", key="create_menu")
+    result_area = st.empty()
+    if clicked:
+        canonical = canonicalize_ingredients(ingredients)
+        if canonical:
+            params = (canonical, category, calories, difficulty, cook_time)
+            label = f"{', '.join(canonical)} | {category} | {calories} kcal | {difficulty} | {cook_time} นาที"
+            similar_index = get_similar_index()
+            similar_response = similar_index.find(canonical, category, calories, difficulty, cook_time,
+                                                  GENERATION_TIER)
+            if similar_response is not None:
+                with span("request_seconds", mode="create", source="similar"):
+                    record_history("create", label, params, parse_menus(similar_response), source="similar",
+                                   tier=GENERATION_TIER)
             else:
-                st.warning("⚠️ ไม่พบเมนูที่ตรงกับเกณฑ์ของคุณ โปรดลองปรับการตั้งค่า")
+                prompt, generation = menu_request("create", params, GENERATION_TIER)
+                chunks = remember_response(
+                    stream_gemini_api(prompt, generation), lambda response_text: similar_index.add(
+                        canonical, category, calories, difficulty, cook_time, GENERATION_TIER, response_text))
+                with result_area.container(), span("request_seconds", mode="create", source="live",
+                                                   tier=GENERATION_TIER):
+                    menu_list = show_menus(chunks, "กำลังสร้างสรรค์ไอเดียอร่อยๆ...",
+                                           "⚠️ ไม่พบเมนูที่ตรงกับเกณฑ์ของคุณ โปรดลองปรับการตั้งค่า")
+                if record_history("create", label, params, menu_list, tier=GENERATION_TIER) is None:
+                    return
         else:
-            st.warning("⚠️ กรุณากรอกวัตถุดิบของคุณ")
+            result_area.warning("⚠️ กรุณากรอกวัตถุดิบของคุณ")
+            return
+    # แสดงผลลัพธ์ล่าสุดจากประวัติ ทำให้การเปลี่ยน widget อื่นไม่ทำให้ผลลัพธ์หายไป
+    with result_area.container():
+        show_history_result("create")
 
 # --- ฟังก์ชันสำหรับโหมดค้นหาเมนูอาหาร ---
 def search_menu_mode():
@@ -262,76 +2234,49 @@ def search_menu_mode():
     with st.expander("⚙️ ตั้งค่าการค้นหา", expanded=True):
         col1, col2 = st.columns(2)
         with col1:
-            country = st.selectbox("ประเทศที่คุณอยู่ในตอนนี้",
-                                   ["ไทย", "ญี่ปุ่น", "เกาหลีใต้", "สหรัฐอเมริกา", "อังกฤษ", "ฝรั่งเศส", "เยอรมนี",
-                                    "จีน", "อินเดีย", "รัสเซีย", "แคนาดา", "บราซิล", "ออสเตรเลีย", "อาร์เจนตินา",
-                                    "เม็กซิโก", "อิตาลี", "สเปน", "เนเธอร์แลนด์", "สวิตเซอร์แลนด์", "เบลเยียม",
-                                    "สวีเดน", "นอร์เวย์", "เดนมาร์ก", "ฟินแลนด์", "โปรตุเกส", "ออสเตรีย", "ไอร์แลนด์",
-                                    "กรีซ", "ตุรกี", "แอฟริกาใต้", "อียิปต์", "ไนจีเรีย", "เคนยา", "โมร็อกโก",
-                                    "แอลจีเรีย", "ซาอุดีอาระเบีย", "สหรัฐอาหรับเอมิเรตส์", "กาตาร์", "โอมาน", "คูเวต",
-                                    "อิหร่าน", "อิรัก", "ปากีสถาน", "บังกลาเทศ", "อินโดนีเซีย", "มาเลเซีย", "สิงคโปร์",
-                                    "ฟิลิปปินส์", "เวียดนาม", "พม่า", "กัมพูชา", "ลาว", "มองโกเลีย", "เกาหลีเหนือ",
-                                    "ไต้หวัน", "ฮ่องกง", "มาเก๊า", "นิวซีแลนด์", "ฟิจิ", "ปาปัวนิวกินี",
-                                    "หมู่เกาะโซโลมอน", "วานูอาตู", "นาอูรู", "ตูวาลู", "คิริบาส", "ไมโครนีเซีย",
-                                    "หมู่เกาะมาร์แชลล์", "ปาเลา", "ซามัว", "ตองกา", "นีวเวย์", "หมู่เกาะคุก",
-                                    "เฟรนช์โปลินีเซีย", "นิวแคลิโดเนีย", "วาลลิสและฟูตูนา",
-                                    "เฟรนช์เซาเทิร์นและแอนตาร์กติกแลนดส์", "เซนต์เฮเลนา", "อัสเซนชัน และตริสตันดากูนยา",
-                                    "หมู่เกาะฟอล์กแลนด์", "เซาท์จอร์เจียและหมู่เกาะเซาท์แซนด์วิช", "หมู่เกาะพิตแคร์น",
-                                    "บริติชอินเดียนโอเชียนเทร์ริทอรี", "หมู่เกาะบริติชเวอร์จิน", "หมู่เกาะเคย์แมน",
-                                    "มอนต์เซอร์รัต", "แองกวิลลา", "อารูบา", "กูราเซา", "ซินต์มาร์เติน", "โบแนร์",
-                                    "เซนต์เอิสตาเชียสและเซนต์มาร์เติน", "กรีนแลนด์", "หมู่เกาะแฟโร", "ยิบรอลตาร์",
-                                    "อากรีอาและบาร์บูดา", "แอนติกาและบาร์บูดา", "บาร์เบโดส", "ดอมินิกา", "เกรนาดา",
-                                    "เซนต์คิตส์และเนวิส", "เซนต์ลูเซีย", "เซนต์วินเซนต์และเกรนาดีนส์",
-                                    "ตรินิแดดและโตเบโก", "แองโกลา", "เบนิน", "บอตสวานา", "บูร์กินาฟาโซ", "บุรุนดี",
-                                    "กาบูเวร์ดี", "แคเมอรูน", "สาธารณรัฐแอฟริกากลาง", "ชาด", "สาธารณรัฐคองโก",
-                                    "สาธารณรัฐประชาธิปไตยคองโก", "โกตดิวัวร์", "จิบูตี", "อียิปต์", "อิเควทอเรียลกินี",
-                                    "เอริเทรีย", "เอสวาตินี", "เอธิโอเปีย", "กาบอง", "แกมเบีย", "กานา", "กินี",
-                                    "กินี-บิสเซา", "เคนยา", "เลโซโท", "ไลบีเรีย", "ลิเบีย", "มาดากัสการ์", "มาลาวี",
-                                    "มาลี", "มอริเตเนีย", "มอริเชียส", "โมร็อกโก", "โมซัมบิก", "นามิเบีย", "ไนเจอร์",
-                                    "ไนจีเรีย", "รวันดา", "เซาตูเมและปรินซิปี", "เซเนกัล", "เซเชลส์", "เซียร์ราลีโอน",
-                                    "โซมาเลีย", "แอฟริกาใต้", "ซูดานใต้", "ซูดาน", "แทนซาเนีย", "โตโก", "ตูนิเซีย",
-                                    "ยูกันดา", "แซมเบีย", "ซิมบับเว"])
-            category = st.selectbox("ประเภทอาหาร",
-                                    ["อาหารไทย", "อาหารญี่ปุ่น", "อาหารเกาหลี", "ฟาสต์ฟู้ด", "อาหารสุขภาพ",
-                                     "อาหารจีน", "อาหารอินเดีย", "อาหารเวียดนาม", "อาหารเม็กซิกัน",
-                                     "อาหารอิตาเลียน", "อาหารทะเล", "อาหารเจ", "อาหารอีสาน", "อาหารใต้",
-                                     "อาหารเหนือ", "อาหารฟิวชั่น", "ขนม", "เครื่องดื่ม", "อาหารตะวันตก"])
+            country = st.selectbox("ประเทศที่คุณอยู่ในตอนนี้", SEARCH_COUNTRIES)
+            category = st.selectbox("ประเภทอาหาร", SEARCH_CATEGORIES)
         with col2:
-            taste = st.radio("รสชาติ", ["เผ็ด", "หวาน", "เค็ม", "เปรี้ยว", "ขม", "อูมามิ", "มัน", "ฝาด", "จืด", "รสจัด", "กลมกล่อม", "กลางๆ"], horizontal=True)
-            budget = st.radio("งบประมาณ", ["ต่ำกว่า 100 บาท", "100 - 300 บาท", "300 - 1000 บาท", "1000 - 10000 บาท", "ไม่จำกัดงบ(ระดับ MrBeast)"], horizontal=True)
+            taste = st.radio("รสชาติ", SEARCH_TASTES, horizontal=True)
+            budget = st.radio("งบประมาณ", SEARCH_BUDGETS, horizontal=True)
     
-    if st.button("🔎 ค้นหาเมนู", key="search_menu"):
-        if budget == "ไม่จำกัดงบ(ระดับ MrBeast)":
-            prompt = (f"ฉันต้องการซื้ออาหาร {category} รสชาติ {taste} ราคา 10000 - 10000000 บาท {budget} "
-                      f"ที่มีขายใน {country} แนะนำ 3 ตัวเลือกเมนู {category} ที่มีขายใน {country} "
-                      f"คั่นด้วย '🍽️ เมนูที่' ไม่ต้องเกริ่นนำ บอกราคาของอาหารด้วย และบอกว่าหาซื้อได้ที่ร้านไหน")
+    clicked = st.button("🔎 ค้นหาเมนู", key="search_menu")
+    result_area = st.empty()
+    if clicked:
+        combo = (country, category, taste, budget)
+        label = " | ".join(combo)
+        catalog = get_menu_catalog()
+        previous = st.session_state.get("last_search_combo")
+        if previous is not None:
+            catalog.record_transition(previous, combo)
+        st.session_state["last_search_combo"] = combo
+        prefetcher = get_prefetcher()
+        prefetcher.claim(combo)
+        entry = catalog.lookup(combo)
+        if entry is not None:
+            menu_list, is_stale = entry
+            if is_stale:
+                schedule_catalog_refresh(combo)
+            with span("request_seconds", mode="search", source="catalog"):
+                record_history("search", label, combo, menu_list, source="catalog")
         else:
-            prompt = (f"ฉันต้องการซื้ออาหาร {category} รสชาติ {taste} ราคา {budget} "
-                      f"ที่มีขายใน {country} แนะนำ 3 ตัวเลือกเมนู {category} ที่มีขายใน {country} "
-                      f"คั่นด้วย '🍽️ เมนูที่' ไม่ต้องเกริ่นนำ บอกราคาของอาหารด้วย และบอกว่าหาซื้อได้ที่ร้านไหน")
-        with st.spinner("กำลังค้นหาตัวเลือกที่ดีที่สุด..."):
-            menu_list = process_menus(call_gemini_api(prompt))
-        if menu_list:
-            st.markdown("<h3>🧑‍🍳 เมนูแนะนำ 3 เมนู:</h3>", unsafe_allow_html=True)
-            cols = st.columns(3)
-            for i, menu in enumerate(menu_list[:3]):
-                with cols[i]:
-                    menu = format_menu_text(menu)
-                    st.markdown(f"""
-                    <div class="menu-column">
-                        <h4>🍽️ เมนูที่ {i+1}</h4>
-                        <p>{menu}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
-        else:
-            st.warning("⚠️ ไม่พบเมนู โปรดลองอีกครั้ง")
+            prompt, generation = menu_request("search", combo, GENERATION_TIER)
+            with result_area.container(), span("request_seconds", mode="search", source="live",
+                                               tier=GENERATION_TIER):
+                menu_list = show_menus(stream_gemini_api(prompt, generation),
+                                       "กำลังค้นหาตัวเลือกที่ดีที่สุด...", "⚠️ ไม่พบเมนู โปรดลองอีกครั้ง")
+            if record_history("search", label, combo, menu_list, tier=GENERATION_TIER) is None:
+                return
+        prefetcher.schedule(combo)
+    with result_area.container():
+        show_history_result("search")
 
 # --- เรียกใช้งานแต่ละโหมดใน Tab ที่เหมาะสม ---
 with tabs[0]:
     create_menu_mode()
 with tabs[1]:
     search_menu_mode()
-with tabs[2]:
+with tabs[2], span("stage_seconds", stage="render_about"):
     st.subheader("🤝 เกี่ยวกับผู้พัฒนา")
     st.markdown("""
     <div class='about-section'>
@@ -377,25 +2322,71 @@ with st.sidebar:
     admin_password = st.text_input("Enter Admin Password:", type="password")
     if admin_password == st.secrets["ADMIN_PASSWORD"]:
         if st.button("Reset Visitor Count and Active Users"):
-            with open(COUNTER_FILE, "w") as f:
-                f.write("0")
-            with open(ACTIVE_USERS_FILE, "w") as f:
-                f.truncate(0)
+            get_state_store().reset()
             st.success("Visitor count and active users reset to 0.")
-            st.experimental_rerun()
+            st.rerun()
         
+        st.markdown("#### ⚡ Response Cache")
+        response_cache = get_response_cache()
+        response_cache.bypass = st.checkbox("Bypass Response Cache", value=response_cache.bypass)
+        cache_stats = response_cache.stats()
+        st.text(f"Entries: {cache_stats['entries']} | Hits: {cache_stats['hits']} "
+                f"(shared {cache_stats['shared_hits']}) | Misses: {cache_stats['misses']} | "
+                f"Hit rate: {cache_stats['hit_rate']:.0%}")
+        if st.button("Clear Response Cache"):
+            response_cache.clear()
+            st.success("Response cache cleared.")
+
+        flight_stats = get_single_flight().stats()
+        st.text(f"Single-flight — In flight: {flight_stats['in_flight']} | Upstream calls: {flight_stats['leaders']} | "
+                f"Coalesced: {flight_stats['coalesced']} | Timeouts: {flight_stats['timeouts']}")
+
+        pool_stats = get_worker_pool().stats()
+        st.text(f"Workers — Running: {pool_stats['running']}/{MAX_UPSTREAM_CALLS} | "
+                f"Queued: {pool_stats['queued']}/{MAX_QUEUED_JOBS} | Rejected: {pool_stats['rejected']} | "
+                f"Expired: {pool_stats['expired']} | Avg wait: {pool_stats['avg_wait']:.2f}s")
+
+        similar_stats = get_similar_index().stats()
+        st.text(f"Similar-ingredient reuse — Hits: {similar_stats['hits']} | Misses: {similar_stats['misses']} | "
+                f"Hit rate: {similar_stats['hit_rate']:.0%}")
+
+        st.markdown("#### 📚 Menu Catalog")
+        st.text(format_catalog_report(get_menu_catalog().stats()))
+
+        st.markdown("#### 🔮 Prefetch")
+        prefetcher = get_prefetcher()
+        prefetcher.enabled = st.checkbox("Enable Prefetch", value=prefetcher.enabled)
+        prefetch_stats = prefetcher.stats()
+        st.text(f"Running: {prefetch_stats['running']}/{PREFETCH_MAX_CONCURRENT} | "
+                f"Issued: {prefetch_stats['issued']} | Completed: {prefetch_stats['completed']} | "
+                f"Failed: {prefetch_stats['failed']} | Skipped (key budget): {prefetch_stats['skipped_budget']}\n"
+                f"Hits: {prefetch_stats['hits']} | Wasted: {prefetch_stats['wasted']} | "
+                f"Unused: {prefetch_stats['unused']} | Hit rate: {prefetch_stats['hit_rate']:.0%}")
+
+        st.markdown("#### 🔑 API Key Pool")
+        st.table(get_key_pool().stats())
+
+        st.markdown("#### ⏱️ Performance")
+        metrics = get_metrics()
+        metrics_summary = metrics.summary()
+        if metrics_summary:
+            st.dataframe([dict(row, **{q: f"{row[q] * 1000:.1f} ms" if row["metric"].endswith("_seconds")
+                                       else f"{row[q]:.0f}" for q in ("p50", "p95", "p99", "max", "mean")})
+                          for row in metrics_summary], hide_index=True)
+        else:
+            st.text("No timing data yet.")
+        st.download_button("Export Prometheus", metrics.to_prometheus(), file_name="metrics.prom",
+                           mime="text/plain")
+        st.download_button("Export JSONL", metrics.to_jsonl(), file_name="metrics.jsonl",
+                           mime="application/x-ndjson")
+
         st.markdown("#### 📂 View Stored Data")
-        def read_file_content(file_path):
-            try:
-                with open(file_path, "r") as f:
-                    content = f.read().strip()
-                    return content if content else "(Empty File)"
-            except FileNotFoundError:
-                return "(File Not Found)"
-        if st.button("View Visitor Count File"):
-            st.text_area("Visitor Count File Content:", read_file_content(COUNTER_FILE), height=70)
-        if st.button("View Active Users File"):
-            st.text_area("Active Users File Content:", read_file_content(ACTIVE_USERS_FILE), height=100)
+        if st.button("View Visitor Count"):
+            st.text_area("Visitor Count:", str(get_visitor_count()), height=70)
+        if st.button("View Active Users"):
+            sessions = get_state_store().sessions()
+            st.text_area("Active Users:", "\n".join(f"{uid},{last_seen}" for uid, last_seen in sessions)
+                         or "(Empty)", height=100)
     else:
         if admin_password != "":
             st.warning("Incorrect password or unauthorized access.")
@@ -0,0 +1,58 @@
+# เวลาแยกเมนูต่อคำตอบจากคำตอบที่บันทึกไว้ใน fixtures/: แยกทั้งข้อความครั้งเดียว และแยกระหว่างสตรีมทีละ chunk
+#
+#   python benchmarks/bench_parse.py --repeat 2000 --chunk-size 16 64
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tests.app_loader import TEST_ENV, load_app  # noqa: E402
+
+
+def best_of(runs, fn):
+    best = float("inf")
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=2000, help="จำนวนรอบต่อการวัด")
+    parser.add_argument("--chunk-size", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--fixtures", default=TEST_ENV["REPLAY_FIXTURES"])
+    args = parser.parse_args()
+
+    app = load_app()
+    with open(args.fixtures, encoding="utf-8") as f:
+        responses = ["".join(json.loads(line)["chunks"]) for line in f if line.strip()]
+    print(f"{len(responses)} responses, {sum(map(len, responses)) // len(responses)} chars on average")
+
+    def parse_whole():
+        for _ in range(args.repeat):
+            for text in responses:
+                app.parse_menus(text)
+
+    elapsed = best_of(3, parse_whole)
+    print(f"parse_menus: {elapsed / args.repeat / len(responses) * 1e6:.1f} µs/response")
+    for size in args.chunk_size:
+        chunked = [[text[i:i + size] for i in range(0, len(text), size)] for text in responses]
+
+        def parse_stream():
+            for _ in range(args.repeat):
+                for chunks in chunked:
+                    for _ in app.iter_menus(chunks):
+                        pass
+
+        elapsed = best_of(3, parse_stream)
+        n_chunks = sum(map(len, chunked))
+        print(f"iter_menus ({size} chars/chunk): {elapsed / args.repeat / len(responses) * 1e6:.1f} µs/response, "
+              f"{elapsed / args.repeat / n_chunks * 1e6:.2f} µs/chunk")
+
+
+if __name__ == "__main__":
+    main()
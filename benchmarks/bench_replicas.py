@@ -0,0 +1,99 @@
+# throughput รวมเทียบกับจำนวน replica: แต่ละ replica เป็น process แยกที่ใช้ shared state ชุดเดียวกัน
+# (SQLite ในโฟลเดอร์ร่วม หรือ Redis จริงเมื่อระบุ --redis-url) และโมเดลจำลองที่มี latency
+# ทุกคำขอนับ page view, อัปเดต presence แล้วขอเมนูผ่าน single-flight, worker pool และ response cache แบบหน้าเว็บ
+#
+#   python benchmarks/bench_replicas.py --replicas 1 2 4 --requests 100 --concurrency 16
+#   python benchmarks/bench_replicas.py --redis-url redis://localhost:6379/15
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tests.app_loader import load_app  # noqa: E402
+
+
+def replica(index, args, shared_dir, barrier, results):
+    env = {"SYNTHETIC_LATENCY": str(args.latency), "SYNTHETIC_CHUNK_DELAY": str(args.chunk_delay)}
+    if args.redis_url:
+        env.update(STATE_BACKEND="redis", REDIS_URL=args.redis_url)
+    else:
+        env.update(STATE_BACKEND="sqlite")
+    app = load_app(**env)
+    if not args.redis_url:
+        # load_app ทำงานในโฟลเดอร์ชั่วคราวของแต่ละ process จึงชี้ store ไปที่ไฟล์ในโฟลเดอร์ร่วมแทน
+        state = app.SQLiteStateStore(os.path.join(shared_dir, "presence.db"))
+        cache = app.ResponseCache(app.CACHE_TTL, app.CACHE_MAX_ENTRIES, app.SQLiteResponseStore(
+            os.path.join(shared_dir, "response_cache.db"), app.CACHE_TTL, app.CACHE_DB_MAX_ENTRIES))
+        app.get_state_store = lambda: state
+        app.get_response_cache = lambda: cache
+    state, cache = app.get_state_store(), app.get_response_cache()
+    rng = random.Random(index)
+    prompts = [f"replica benchmark {rng.randrange(args.shared_prompts)}" if args.shared_prompts
+               else f"replica benchmark {index} {i}" for i in range(args.requests)]
+
+    def page_view(i):
+        now = time.time()
+        state.increment(app.VISITOR_COUNTER)
+        state.touch(f"replica-{index}-{i % args.concurrency}", now)
+        state.count_active(now - app.ACTIVE_TIMEOUT)
+        return app.load_test_request((prompts[i], ("search", "full")))
+
+    barrier.wait()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        outcomes = list(executor.map(page_view, range(args.requests)))
+    results.put((outcomes, cache.stats()["shared_hits"]))
+
+
+def run(args, replicas):
+    context = multiprocessing.get_context("spawn")
+    shared_dir = tempfile.mkdtemp(prefix="smart-cooking-replicas-")
+    barrier = context.Barrier(replicas + 1)
+    results = context.Queue()
+    processes = [context.Process(target=replica, args=(n, args, shared_dir, barrier, results)) for n in range(replicas)]
+    for process in processes:
+        process.start()
+    # เริ่มจับเวลาหลังทุก replica import แอปเสร็จแล้ว
+    barrier.wait()
+    started = time.perf_counter()
+    collected = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    outcomes = [outcome for replica_outcomes, _ in collected for outcome in replica_outcomes]
+    return elapsed, outcomes, sum(shared_hits for _, shared_hits in collected)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replicas", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=100, help="จำนวนคำขอต่อ replica")
+    parser.add_argument("--concurrency", type=int, default=16, help="ผู้ใช้จำลองพร้อมกันต่อ replica")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--chunk-delay", type=float, default=0.01)
+    parser.add_argument("--shared-prompts", type=int, default=0,
+                        help="สุ่ม prompt จากชุดร่วมขนาดนี้ เพื่อวัดการใช้ cache ข้าม replica (0 = ทุกคำขอไม่ซ้ำกัน)")
+    parser.add_argument("--redis-url", help="ใช้ Redis จริงเป็น shared state แทน SQLite")
+    args = parser.parse_args()
+
+    print(f"State: {'redis' if args.redis_url else 'sqlite'} | Requests per replica: {args.requests} | "
+          f"Concurrency per replica: {args.concurrency} | Latency: {args.latency}s")
+    print(f"{'replicas':>8} {'req/s':>8} {'speedup':>8} {'p50':>7} {'p95':>7} {'ok':>6} {'other':>6} {'shared hits':>12}")
+    baseline = None
+    for replicas in args.replicas:
+        elapsed, outcomes, shared_hits = run(args, replicas)
+        latencies = sorted(latency for latency, _, outcome in outcomes if outcome == "ok")
+        ok = len(latencies)
+        throughput = ok / elapsed
+        baseline = baseline or throughput / replicas
+        print(f"{replicas:>8} {throughput:>8.2f} {throughput / baseline:>7.2f}x "
+              f"{latencies[ok // 2] if ok else 0:>6.2f}s {latencies[int(0.95 * ok)] if ok else 0:>6.2f}s "
+              f"{ok:>6} {len(outcomes) - ok:>6} {shared_hits:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# เวลาและหน่วยความจำต่อการ rerun ของหน้าเว็บ วัดด้วย AppTest ของ Streamlit (ไม่ต้องเปิด browser)
+# เปรียบเทียบก่อน/หลังได้ด้วย --rev ซึ่งดึง app.py ของ commit นั้นจาก git มาวัดคู่กัน
+#
+#   python benchmarks/bench_rerun.py --reruns 50 --rev HEAD~1
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, local_script_runner
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tests.app_loader import APP_FILE, ROOT, TEST_ENV, prepare_workdir  # noqa: E402
+
+
+def app_at(rev):
+    if rev is None:
+        return APP_FILE
+    source = subprocess.run(["git", "show", f"{rev}:app.py"], cwd=ROOT, capture_output=True, check=True).stdout
+    path = os.path.join(tempfile.mkdtemp(prefix="smart-cooking-rev-"), "app.py")
+    with open(path, "wb") as f:
+        f.write(source)
+    return path
+
+
+def measure(app_file, reruns, search):
+    at = AppTest.from_file(app_file, default_timeout=60)
+    at.run()
+    if search:
+        # วัดหน้าที่มีผลลัพธ์ในประวัติแล้ว ซึ่งเป็นสภาพปกติหลังผู้ใช้ค้นหาครั้งแรก
+        at.button(key="search_menu").click().run()
+    if at.exception:
+        raise SystemExit(f"{app_file}: {at.exception[0].message}")
+    times = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        at.run()
+        times.append(time.perf_counter() - started)
+    # tracemalloc ทำให้ช้าลงหลายเท่า จึงวัดหน่วยความจำแยกอีกรอบหลังวัดเวลาแล้ว
+    allocations = []
+    tracemalloc.start()
+    for _ in range(reruns):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        at.run()
+        allocations.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return sorted(times), sorted(allocations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reruns", type=int, default=50)
+    parser.add_argument("--rev", help="commit ที่จะวัดเปรียบเทียบกับ app.py ปัจจุบัน เช่น HEAD~1")
+    parser.add_argument("--search", action="store_true", help="กดค้นหาหนึ่งครั้งก่อนเริ่มวัด (commit ก่อนมี MODEL_BACKEND จะเรียก API จริง)")
+    parser.add_argument("--include-compile", action="store_true",
+                        help="compile app.py ใหม่ทุก rerun ตามค่าเริ่มต้นของ AppTest")
+    args = parser.parse_args()
+
+    if not args.include_compile:
+        # AppTest สร้าง ScriptCache ใหม่ทุกครั้งที่ run จึง compile และแปลง AST ของ app.py ใหม่ทุก rerun
+        # ซึ่งกินเวลาส่วนใหญ่ `streamlit run` จริง compile ครั้งเดียว จึงใช้ cache ร่วมกันเพื่อวัดเฉพาะการรันสคริปต์
+        script_cache = ScriptCache()
+        local_script_runner.ScriptCache = lambda: script_cache
+    os.environ.update(TEST_ENV)
+    prepare_workdir()
+    targets = ([(args.rev, app_at(args.rev))] if args.rev else []) + [("working tree", APP_FILE)]
+    print(f"{'app.py':>14} {'p50':>8} {'p95':>8} {'max':>8} {'peak alloc p50':>15}")
+    for label, app_file in targets:
+        times, allocations = measure(app_file, args.reruns, args.search)
+        print(f"{label:>14} {statistics.median(times) * 1000:>6.1f}ms {times[int(0.95 * len(times))] * 1000:>6.1f}ms "
+              f"{times[-1] * 1000:>6.1f}ms {statistics.median(allocations) / 1024:>12.0f}KiB")
+
+
+if __name__ == "__main__":
+    main()
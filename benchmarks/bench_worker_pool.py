@@ -0,0 +1,47 @@
+# Load generator ของ worker pool: ยิงคำขอที่ไม่ซ้ำกันพร้อมกันหลายระดับเข้าหาโมเดลจำลองที่มี latency
+# แล้ววัด throughput, latency p50/p95/p99 และจำนวนคำขอที่ถูกปฏิเสธเพราะคิวเต็ม
+#
+#   python benchmarks/bench_worker_pool.py --requests 200 --concurrency 8 32 64 128 --latency 0.5
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tests.app_loader import load_app  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200, help="จำนวนคำขอต่อระดับ concurrency")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 64, 128])
+    parser.add_argument("--latency", type=float, default=0.5, help="ค่ามัธยฐาน (วินาที) ก่อน chunk แรกของโมเดลจำลอง")
+    parser.add_argument("--chunk-delay", type=float, default=0.01)
+    args = parser.parse_args()
+
+    app = load_app(SYNTHETIC_LATENCY=str(args.latency), SYNTHETIC_CHUNK_DELAY=str(args.chunk_delay))
+    # วัดเฉพาะ worker pool: ไม่ตอบจาก cache และทุก prompt ไม่ซ้ำกันจึงไม่ถูกรวมด้วย single-flight
+    app.get_response_cache().bypass = True
+    workers = app.get_worker_pool()
+    print(f"Workers: {app.MAX_UPSTREAM_CALLS} | Queue: {app.MAX_QUEUED_JOBS} | "
+          f"Latency: {args.latency}s | Requests per level: {args.requests}")
+    print(f"{'concurrency':>11} {'req/s':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'ok':>5} {'rejected':>8} {'other':>6}")
+    for concurrency in args.concurrency:
+        requests = [(f"benchmark {concurrency} {i}", ("search", "full")) for i in range(args.requests)]
+        rejected_before = workers.stats()["rejected"]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(app.load_test_request, requests))
+        elapsed = time.perf_counter() - started
+        latencies = sorted(latency for latency, _, outcome in results if outcome == "ok")
+        ok = len(latencies)
+        rejected = sum(1 for _, _, outcome in results if outcome == "rejected")
+        print(f"{concurrency:>11} {ok / elapsed:>8.2f} {app.percentile(latencies, 0.5):>6.2f}s "
+              f"{app.percentile(latencies, 0.95):>6.2f}s {app.percentile(latencies, 0.99):>6.2f}s "
+              f"{ok:>5} {rejected:>8} {len(results) - ok - rejected:>6}")
+        assert workers.stats()["rejected"] - rejected_before == rejected
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# โหลด app.py เป็น module (Streamlit bare mode) สำหรับ tests และ benchmarks
+# app.py เป็นสคริปต์ Streamlit การ import จึงรันหน้าเว็บหนึ่งรอบโดยไม่มี browser และอ่าน st.secrets ทันที
+# ตัวโหลดจึงย้ายไปทำงานในโฟลเดอร์ชั่วคราวที่มี secrets สำหรับทดสอบ ไฟล์ SQLite ที่แอปสร้างก็จะอยู่ในนั้นด้วย
+import importlib.util
+import logging
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(ROOT, "app.py")
+FIXTURES_DIR = os.path.join(ROOT, "fixtures")
+
+TEST_SECRETS = 'API_KEYS = ["test-key-aaaa", "test-key-bbbb"]\nADMIN_PASSWORD = "admin"\n'
+TEST_ENV = {
+    "MODEL_BACKEND": "synthetic",
+    "SYNTHETIC_CHUNK_DELAY": "0",
+    "STATE_BACKEND": "memory",
+    "PREFETCH_ENABLED": "0",
+    "REPLAY_FIXTURES": os.path.join(FIXTURES_DIR, "gemini_responses.jsonl"),
+    "REPLAY_SPEED": "0",
+}
+
+
+def prepare_workdir(path=None):
+    path = path or tempfile.mkdtemp(prefix="smart-cooking-")
+    os.makedirs(os.path.join(path, ".streamlit"), exist_ok=True)
+    with open(os.path.join(path, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(TEST_SECRETS)
+    os.chdir(path)
+    return path
+
+
+def load_app(**env):
+    if "app" in sys.modules:
+        return sys.modules["app"]
+    os.environ.update(TEST_ENV)
+    os.environ.update(env)
+    prepare_workdir()
+    spec = importlib.util.spec_from_file_location("app", APP_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["app"] = module
+    spec.loader.exec_module(module)
+    # worker thread ไม่มี ScriptRunContext ใน bare mode และ Streamlit จะเตือนทุกครั้งที่ thread ใหม่แตะ st.*
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    return module
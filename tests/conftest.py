@@ -0,0 +1,8 @@
+import pytest
+
+from tests.app_loader import load_app
+
+
+@pytest.fixture(scope="session")
+def app():
+    return load_app()
@@ -0,0 +1,90 @@
+# สลับ key เมื่อเจอ quota error, พัก key แบบเพิ่มเป็นเท่าตัว และรูปแบบข้อความ quota error ของ SDK
+import pytest
+from google.genai import errors
+
+QUOTA_ERROR = str(errors.ClientError(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                                                     "message": "You exceeded your current quota"}}))
+GENERATION = ("search", "full")
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    def __init__(self, error=None, text="ok"):
+        self.error = error
+        self.text = text
+        self.calls = 0
+
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        self.calls += 1
+        if self.error:
+            raise Exception(self.error)
+        return iter([Chunk(self.text)])
+
+
+@pytest.fixture
+def pool(app, monkeypatch):
+    key_pool = app.KeyPool(["test-key-aaaa", "test-key-bbbb"])
+    monkeypatch.setattr(app, "get_key_pool", lambda: key_pool)
+    return key_pool
+
+
+def stream(app, prompt="prompt"):
+    cache = app.ResponseCache(60, 10)
+    return "".join(app.stream_from_key_pool(prompt, cache, cache.make_key(prompt, app.MODEL_NAME), GENERATION))
+
+
+@pytest.mark.parametrize("message", [QUOTA_ERROR, "429 Quota exceeded for quota metric", "insufficient_quota"])
+def test_quota_error_messages(app, message):
+    assert app.is_quota_error(message)
+
+
+def test_other_errors_are_not_quota_errors(app):
+    assert not app.is_quota_error("500 INTERNAL. {'error': {'code': 500}}")
+
+
+def test_quota_error_fails_over_to_next_key(app, pool):
+    exhausted, healthy = StubModel(error=QUOTA_ERROR), StubModel(text="menu")
+    pool.keys[0].model, pool.keys[1].model = exhausted, healthy
+    assert stream(app) == "menu"
+    assert (exhausted.calls, healthy.calls) == (1, 1)
+    stats = pool.stats()
+    assert stats[0]["quota_errors"] == 1 and stats[0]["cooldown_s"] > 0
+    # key ที่พักอยู่จะไม่ถูกเลือกจนกว่าจะพ้นช่วงพัก
+    assert stream(app, "another prompt") == "menu"
+    assert (exhausted.calls, healthy.calls) == (1, 2)
+
+
+def test_all_keys_exhausted(app, pool):
+    for key_state in pool.keys:
+        key_state.model = StubModel(error=QUOTA_ERROR)
+    assert stream(app).startswith("⚠️")
+
+
+def test_cooldown_doubles_on_repeated_quota_errors(app, pool):
+    key_state = pool.keys[0]
+    cooldowns = []
+    for _ in range(3):
+        pool.release(pool.acquire(), 0.1, QUOTA_ERROR)
+        cooldowns.append(key_state.cooldown_until)
+        key_state.cooldown_until = 0.0
+        pool.next_index = 0
+    now = cooldowns[0] - app.KEY_COOLDOWN_BASE
+    assert [round(until - now) for until in cooldowns] == [app.KEY_COOLDOWN_BASE * 2 ** n for n in range(3)]
+
+
+def test_success_resets_backoff(app, pool):
+    pool.release(pool.acquire(), 0.1, QUOTA_ERROR)
+    pool.keys[0].cooldown_until = 0.0
+    pool.next_index = 0
+    pool.release(pool.acquire(), 0.1)
+    assert pool.keys[0].consecutive_quota_errors == 0
+
+
+def test_gemini_backend_uses_one_client_per_key(app):
+    first, second = app.GeminiModel("test-key-aaaa"), app.GeminiModel("test-key-bbbb")
+    assert first.client is not second.client
+    assert first.client._api_client.api_key == "test-key-aaaa"
@@ -0,0 +1,84 @@
+# fuzz ตัวแยกเมนูด้วยคำตอบที่บันทึกไว้: ตัดเป็น chunk แบบสุ่ม ตัดท้าย และทำให้เสียหาย
+import json
+import random
+
+import pytest
+
+from tests.app_loader import TEST_ENV
+
+FREE_TEXT = ("🍽️ เมนูที่ 1: **ข้าวผัดไข่**\nวัตถุดิบ: ข้าว ไข่\n🍽️ เมนูที่ 2: **ต้มจืดเต้าหู้**\nวัตถุดิบ: เต้าหู้ หมูสับ\n"
+             "🍽️ เมนูที่ 3: **ยำวุ้นเส้น**\n- วุ้นเส้น\n- กุ้ง")
+JSON_ARRAY = json.dumps([{"name": "ข้าวมันไก่", "price": "50 บาท"}, {"name": "ข้าวขาหมู", "price": "60 บาท"}],
+                        ensure_ascii=False)
+FENCED = "```json\n" + '{"name": "ผัดไทย", "steps": ["ผัด"]}\n{"name": "หอยทอด"}\n```'
+SPLITS_PER_RESPONSE = 50
+
+
+@pytest.fixture(scope="module")
+def corpus(app):
+    with open(TEST_ENV["REPLAY_FIXTURES"], encoding="utf-8") as f:
+        responses = ["".join(json.loads(line)["chunks"]) for line in f if line.strip()]
+    synthetic = app.SyntheticModel("fuzz").generate_content("ไข่เจียว")
+    return responses + [synthetic.text, FREE_TEXT, JSON_ARRAY, FENCED]
+
+
+def random_chunks(rng, text):
+    chunks, start = [], 0
+    while start < len(text):
+        end = start + rng.randint(1, 40)
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+def as_dicts(menu_list):
+    return [menu.to_dict() for menu in menu_list]
+
+
+def stream(app, chunks):
+    parser = app.MenuStreamParser()
+    partial = [parser.feed(chunk) for chunk in chunks]
+    return partial, parser.finish()
+
+
+def test_random_chunking_matches_whole_parse(app, corpus):
+    rng = random.Random(0)
+    for text in corpus:
+        expected = as_dicts(app.parse_menus(text))
+        assert expected
+        for _ in range(SPLITS_PER_RESPONSE):
+            partial, final = stream(app, random_chunks(rng, text))
+            assert as_dicts(final) == expected
+            # ระหว่างสตรีมต้องมีการ์ดไม่เกินผลสุดท้าย (JSON Lines ไม่มีการ์ดที่หายไปแล้วกลับมา)
+            assert all(len(menus) <= max(len(expected), 1) for menus in partial)
+
+
+def test_truncated_and_corrupted_responses_never_raise(app, corpus):
+    rng = random.Random(1)
+    for text in corpus:
+        for _ in range(SPLITS_PER_RESPONSE):
+            damaged = list(text[:rng.randrange(len(text) + 1)])
+            for _ in range(rng.randint(0, 5)):
+                damaged.insert(rng.randrange(len(damaged) + 1), rng.choice('{}[]",:\n`*'))
+            damaged = "".join(damaged)
+            for menu in app.parse_menus(damaged) + stream(app, random_chunks(rng, damaged))[1]:
+                assert isinstance(menu, app.Menu)
+
+
+@pytest.mark.parametrize("index", [0, 4])
+def test_trailing_stream_error_is_kept(app, corpus, index):
+    text = corpus[index]
+    lines = text.split("\n")
+    chunks = random_chunks(random.Random(2), "\n".join(lines[:2]) + "\n")
+    error = app.StreamError("❌ เกิดข้อผิดพลาด: 500 Internal error")
+    partial, final = stream(app, chunks + [error])
+    assert len(final) == 3 and final[-1].text == error
+    assert partial[-1][-1].text == error
+    assert app.is_error_result(final) and app.is_error_result(partial[-1])
+    assert not app.is_error_result(final[:-1])
+
+
+def test_error_only_stream(app):
+    partial, final = stream(app, [app.BUSY_MESSAGE])
+    assert as_dicts(final) == as_dicts(partial[-1]) == [app.Menu(text=app.BUSY_MESSAGE).to_dict()]
+    assert app.is_error_result(final)
@@ -0,0 +1,89 @@
+# Metrics: สรุป percentile, span/timed และไฟล์ export ที่ Prometheus/JSONL อ่านได้
+import json
+import time
+from collections import Counter
+
+import pytest
+
+
+@pytest.fixture
+def metrics(app):
+    metrics = app.Metrics(100)
+    for value in range(1, 101):
+        metrics.observe("stage_seconds", value / 1000, stage="render_css")
+        metrics.observe("stage_seconds", value / 100, stage="render_about")
+    metrics.observe("gemini_call_seconds", 1.5, key="key1", outcome="ok", tier="full")
+    metrics.observe("gemini_call_seconds", 2.5, key="key2", outcome="quota", tier="full")
+    metrics.incr("gemini_calls", key="key1", outcome="ok")
+    metrics.incr("gemini_calls", key="key2", outcome="quota")
+    metrics.incr("gemini_tokens", 120, kind="prompt", tier="full")
+    metrics.incr("visits", label='say "hi"\\n')
+    return metrics
+
+
+def test_summary_percentiles(metrics):
+    rows = {(row["metric"], row["labels"]): row for row in metrics.summary()}
+    row = rows[("stage_seconds", "stage=render_css")]
+    assert row["count"] == 100 and row["max"] == 0.1
+    assert (row["p50"], row["p95"], row["p99"]) == (0.051, 0.096, 0.1)
+    assert row["mean"] == pytest.approx(0.0505)
+
+
+def test_window_keeps_recent_samples_but_totals_everything(app):
+    metrics = app.Metrics(10)
+    for value in range(100):
+        metrics.observe("latency", value)
+    (row,) = metrics.summary()
+    assert row["count"] == 100 and row["p50"] >= 90
+    assert row["mean"] == pytest.approx(49.5)
+
+
+def test_span_and_timed_record_elapsed_time(app, monkeypatch):
+    metrics = app.Metrics(10)
+    monkeypatch.setattr(app, "get_metrics", lambda: metrics)
+
+    @app.timed("work")
+    def work():
+        time.sleep(0.01)
+        return "done"
+
+    assert work() == "done"
+    with app.span("request_seconds", mode="search"):
+        pass
+    rows = {(row["metric"], row["labels"]): row for row in metrics.summary()}
+    assert rows[("stage_seconds", "stage=work")]["max"] >= 0.01
+    assert rows[("request_seconds", "mode=search")]["count"] == 1
+
+
+def test_prometheus_has_one_type_line_per_family(metrics):
+    types = Counter(line.split()[2] for line in metrics.to_prometheus().splitlines() if line.startswith("# TYPE"))
+    assert types == {
+        "smart_cooking_stage_seconds": 1,
+        "smart_cooking_gemini_call_seconds": 1,
+        "smart_cooking_gemini_calls_total": 1,
+        "smart_cooking_gemini_tokens_total": 1,
+        "smart_cooking_visits_total": 1,
+    }
+
+
+def test_prometheus_export_parses(metrics):
+    parser = pytest.importorskip("prometheus_client.parser")
+    families = {family.name: family for family in parser.text_string_to_metric_families(metrics.to_prometheus())}
+    assert families["smart_cooking_stage_seconds"].type == "summary"
+    samples = {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+               for sample in families["smart_cooking_stage_seconds"].samples}
+    assert samples[("smart_cooking_stage_seconds_count", (("stage", "render_about"),))] == 100
+    assert samples[("smart_cooking_stage_seconds", (("quantile", "0.5"), ("stage", "render_css")))] == 0.051
+    counters = {family.type for name, family in families.items() if name.endswith(("calls", "tokens", "visits"))}
+    assert counters == {"counter"}
+    visits = families["smart_cooking_visits"].samples[0]
+    assert visits.labels == {"label": 'say "hi"\\n'}
+
+
+def test_jsonl_export(metrics):
+    records = [json.loads(line) for line in metrics.to_jsonl().splitlines()]
+    latency = [record for record in records if record["type"] == "latency"]
+    counters = {(record["metric"], record["labels"]): record["value"] for record in records
+                if record["type"] == "counter"}
+    assert len(latency) == 4
+    assert counters[("gemini_tokens", "kind=prompt,tier=full")] == 120
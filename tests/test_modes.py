@@ -0,0 +1,157 @@
+# ขับทั้งสองโหมดของหน้าเว็บด้วย AppTest โดยตอบจากคำตอบที่บันทึกไว้ใน fixtures/ (MODEL_BACKEND=replay)
+# และรัน --loadtest ของทั้ง backend จำลองและ replay
+import json
+
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+from tests.app_loader import APP_FILE, TEST_ENV, prepare_workdir
+
+SEARCH_MENUS = ["ผัดกะเพราหมูสับไข่ดาว", "ส้มตำไทย", "ต้มยำกุ้งน้ำใส"]
+CREATE_MENUS = ["ไข่เจียวหมูสับ", "ไข่ตุ๋นหมูสับ", "ผัดไข่หมูสับ"]
+
+
+def run_page(monkeypatch, tmp_path, tiered, **env):
+    # REPLAY_STRICT=1: ทุกคำขอของหน้าเว็บต้องตรงกับที่บันทึกไว้ (test ที่ต้องการ prompt นอก fixtures ส่งค่าอื่นมาแทน)
+    defaults = dict(TEST_ENV, MODEL_BACKEND="replay", REPLAY_STRICT="1", TIERED_GENERATION="1" if tiered else "0")
+    for name, value in dict(defaults, **env).items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.chdir(tmp_path)
+    prepare_workdir(str(tmp_path))
+    # cache_resource อยู่ระดับ process: เริ่ม key pool, cache และ catalog ใหม่ในโฟลเดอร์ของ test นี้
+    st.cache_resource.clear()
+    at = AppTest.from_file(APP_FILE, default_timeout=30)
+    at.run()
+    assert not at.exception
+    return at
+
+
+@pytest.fixture
+def page(monkeypatch, tmp_path):
+    yield lambda tiered=False, **env: run_page(monkeypatch, tmp_path, tiered, **env)
+    st.cache_resource.clear()
+
+
+def card_names(at):
+    cards = [markdown.value for markdown in at.markdown if '<div class="menu-column">' in markdown.value]
+    return [card.split("<b>")[1].split("</b>")[0] for card in cards]
+
+
+def history(at):
+    return list(at.session_state["menu_history"])
+
+
+def assert_history_bytes(app, at):
+    # ขนาดรวมที่นับไว้ต้องตรงกับขนาดจริงของทุก entry แม้เมนูจะถูกแทนที่หลังบันทึกแล้ว
+    entries = history(at)
+    assert all(entry["size"] == app.menus_size(entry["menus"]) for entry in entries)
+    assert at.session_state["menu_history_bytes"] == sum(entry["size"] for entry in entries)
+
+
+def test_search_mode(page):
+    at = page()
+    at.button(key="search_menu").click().run()
+    assert not at.exception
+    assert card_names(at) == SEARCH_MENUS
+    assert history(at)[-1]["source"] == "live"
+
+
+def test_create_mode_and_similar_request(page):
+    at = page()
+    at.text_area[0].input("ไข่, หมูสับ")
+    at.button(key="create_menu").click().run()
+    assert not at.exception
+    assert card_names(at) == CREATE_MENUS
+    # วัตถุดิบชุดเดิมที่เขียนต่างกันตอบจาก similar index โดยไม่เรียกโมเดล
+    at.text_area[0].input("หมูสับ ,ไข่")
+    at.button(key="create_menu").click().run()
+    assert not at.exception
+    assert history(at)[-1]["source"] == "similar"
+    assert card_names(at) == CREATE_MENUS
+
+
+@pytest.mark.parametrize("mode, button", [("search", "search_menu"), ("create", "create_menu")])
+def test_tiered_summary_then_detail(app, page, mode, button):
+    at = page(tiered=True)
+    if mode == "create":
+        at.text_area[0].input("ไข่, หมูสับ")
+    at.button(key=button).click().run()
+    assert not at.exception
+    entry = history(at)[-1]
+    assert entry["tier"] == "summary" and not entry["menus"][0].detailed
+    at.button(key=f"detail_{entry['id']}_0").click().run()
+    assert not at.exception
+    detail = history(at)[-1]["menus"][0]
+    assert detail.detailed and detail.ingredients
+    assert_history_bytes(app, at)
+
+
+def test_regenerate_replaces_only_that_menu(app, page):
+    # prompt ของการสร้างใหม่ (count=1 และ exclude) ไม่ได้บันทึกไว้: replay ตอบด้วยคำตอบของ generation_config เดียวกัน
+    at = page(REPLAY_STRICT="0")
+    at.button(key="search_menu").click().run()
+    entry = history(at)[-1]
+    before = [menu.to_dict() for menu in entry["menus"]]
+    at.button(key=f"regenerate_{entry['id']}_1").click().run()
+    assert not at.exception
+    assert [item["id"] for item in history(at)] == [entry["id"]]
+    after = [menu.to_dict() for menu in history(at)[-1]["menus"]]
+    assert (after[0], after[2]) == (before[0], before[2])
+    assert after[1] != before[1]
+    names = card_names(at)
+    assert (names[0], names[2]) == (SEARCH_MENUS[0], SEARCH_MENUS[2]) and names[1] != SEARCH_MENUS[1]
+    assert_history_bytes(app, at)
+
+
+def test_history_keeps_the_latest_entries(app, page):
+    at = page(HISTORY_MAX_ENTRIES="3")
+    for _ in range(5):
+        at.button(key="search_menu").click().run()
+    assert not at.exception
+    assert [entry["id"] for entry in history(at)] == [3, 4, 5]
+    assert_history_bytes(app, at)
+
+
+def test_history_byte_cap_keeps_the_newest_entry(app, page):
+    # ผลลัพธ์ล่าสุดอยู่เสมอแม้ตัวมันเองจะใหญ่เกินเพดาน
+    at = page(HISTORY_MAX_BYTES="1")
+    at.button(key="search_menu").click().run()
+    at.text_area[0].input("ไข่, หมูสับ")
+    at.button(key="create_menu").click().run()
+    assert not at.exception
+    assert [(entry["id"], entry["mode"]) for entry in history(at)] == [(2, "create")]
+    assert card_names(at) == CREATE_MENUS
+    assert_history_bytes(app, at)
+
+
+def test_admin_reset(page):
+    at = page()
+    assert at.session_state["visitor_count"] >= 1
+    at.sidebar.text_input[0].input("admin").run()
+    reset = next(button for button in at.sidebar.button if button.label.startswith("Reset Visitor Count"))
+    reset.click().run()
+    assert not at.exception
+    # st.rerun() หลัง reset นับ session นี้ใหม่เป็นผู้เข้าชมคนแรก
+    assert at.session_state["visitor_count"] == 1
+
+
+def test_fixture_corpus_is_well_formed(app):
+    with open(TEST_ENV["REPLAY_FIXTURES"], encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    for record in records:
+        assert record["key"] == app.ResponseCache.make_key(record["prompt"], app.MODEL_NAME,
+                                                           record["generation_config"])
+        assert not app.is_error_result(app.parse_menus("".join(record["chunks"])))
+
+
+@pytest.mark.parametrize("backend", ["synthetic", "replay"])
+def test_load_test(app, monkeypatch, capsys, backend):
+    key_pool = app.KeyPool(app.API_KEYS)
+    monkeypatch.setattr(app, "MODEL_BACKEND", backend)
+    monkeypatch.setattr(app, "get_key_pool", lambda: key_pool)
+    monkeypatch.setattr(app, "get_response_cache", lambda: app.ResponseCache(60, 10))
+    app.run_load_test(6, 3)
+    output = capsys.readouterr().out
+    assert output.count("outcomes: ok=6") == 2, output
+    assert not app.SHARE_KEY_QUOTAS
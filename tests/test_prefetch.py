@@ -0,0 +1,74 @@
+# Prefetcher ต้องไม่เรียก API พร้อมกันเกิน PREFETCH_MAX_CONCURRENT แม้หลาย session จะ schedule พร้อมกัน
+import threading
+import time
+
+import pytest
+
+SESSIONS = 16
+COMBOS = [("ไทย", "อาหารไทย", taste, "ต่ำกว่า 100 บาท") for taste in ("เผ็ด", "หวาน", "เค็ม", "เปรี้ยว")]
+
+
+@pytest.fixture
+def prefetcher(app, monkeypatch, tmp_path):
+    class SlowModel(app.SyntheticModel):
+        def generate_content(self, prompt, stream=False, generation_config=None):
+            time.sleep(0.2)
+            return super().generate_content(prompt, stream, generation_config)
+
+    key_pool = app.KeyPool(["test-key-aaaa", "test-key-bbbb"])
+    catalog = app.MenuCatalog(str(tmp_path / "catalog.db"))
+    cache = app.ResponseCache(60, 100)
+    flights = app.SingleFlight()
+    workers = app.WorkerPool(app.MAX_UPSTREAM_CALLS, app.MAX_QUEUED_JOBS)
+    monkeypatch.setitem(app.MODEL_BACKENDS, app.MODEL_BACKEND, SlowModel)
+    monkeypatch.setattr(app, "get_key_pool", lambda: key_pool)
+    monkeypatch.setattr(app, "get_menu_catalog", lambda: catalog)
+    monkeypatch.setattr(app, "get_response_cache", lambda: cache)
+    monkeypatch.setattr(app, "get_single_flight", lambda: flights)
+    monkeypatch.setattr(app, "get_worker_pool", lambda: workers)
+    return app.Prefetcher(True)
+
+
+def schedule_concurrently(prefetcher, combos):
+    barrier = threading.Barrier(len(combos))
+
+    def session(combo):
+        barrier.wait()
+        prefetcher.schedule(combo)
+
+    threads = [threading.Thread(target=session, args=(combo,)) for combo in combos]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+
+def wait_idle(prefetcher, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with prefetcher.lock:
+            if not prefetcher.running:
+                return
+        time.sleep(0.01)
+    raise AssertionError("prefetch ยังไม่เสร็จ")
+
+
+def test_concurrent_schedules_respect_the_cap(app, prefetcher):
+    schedule_concurrently(prefetcher, [COMBOS[i % len(COMBOS)] for i in range(SESSIONS)])
+    with prefetcher.lock:
+        started, running = prefetcher.issued, prefetcher.running
+    assert 0 < started <= app.PREFETCH_MAX_CONCURRENT
+    assert running == started
+    wait_idle(prefetcher)
+    assert prefetcher.completed == started and not prefetcher.pending
+
+
+def test_skipped_candidates_release_their_slot(app, prefetcher):
+    # คำตอบที่มีใน cache แล้วไม่ต้อง prefetch และต้องไม่ค้างช่องที่จองไว้
+    cache = app.get_response_cache()
+    for neighbor in prefetcher.candidates(COMBOS[0], app.PREFETCH_CANDIDATES):
+        prompt, generation = app.menu_request("search", neighbor, app.GENERATION_TIER)
+        cache.set(app.response_key(prompt, generation), "cached")
+    prefetcher.schedule(COMBOS[0])
+    with prefetcher.lock:
+        assert prefetcher.running == 0 and not prefetcher.pending and prefetcher.issued == 0
@@ -0,0 +1,131 @@
+# RedisStateStore และ RedisResponseStore บน fakeredis: หลาย replica ใช้ server เดียวกันต้องเห็นค่าชุดเดียวกัน
+import functools
+import time
+
+import pytest
+import streamlit as st
+
+from tests.test_state_store import THREADS, assert_consistent, hammer_threads
+
+fakeredis = pytest.importorskip("fakeredis")
+redis = pytest.importorskip("redis")
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def client(server):
+    return fakeredis.FakeRedis(server=server, decode_responses=True)
+
+
+def test_state_store_threads(app, server):
+    store = app.RedisStateStore(client(server))
+    start = store.get("visitors")
+    hammer_threads(store, 0, THREADS)
+    assert_consistent(store, start, THREADS)
+
+
+def test_replicas_share_counters_and_presence(app, server):
+    first, second = app.RedisStateStore(client(server)), app.RedisStateStore(client(server))
+    start = first.get("visitors")
+    first.increment("visitors")
+    second.increment("visitors")
+    now = time.time()
+    first.touch("session-a", now)
+    second.touch("session-b", now)
+    second.touch("session-old", now - 120)
+    assert first.get("visitors") == second.get("visitors") == start + 2
+    assert first.count_active(now - 60) == 2
+    assert sorted(session for session, _ in second.sessions()) == ["session-a", "session-b"]
+
+
+def test_reset_keeps_key_quotas(app, server):
+    store = app.RedisStateStore(client(server))
+    store.increment("visitors")
+    store.touch("session", time.time())
+    store.set_key_quota("key", 123.0, 2)
+    store.reset()
+    assert store.get("visitors") == 0
+    assert store.sessions() == []
+    assert store.key_quotas() == {"key": (123.0, 2)}
+
+
+def test_key_cooldown_is_shared_between_replicas(app, server):
+    api_keys = ["test-key-aaaa", "test-key-bbbb"]
+    first = app.KeyPool(api_keys, app.RedisStateStore(client(server)))
+    second = app.KeyPool(api_keys, app.RedisStateStore(client(server)))
+    key_state = first.acquire()
+    first.release(key_state, 0.1, "429 RESOURCE_EXHAUSTED")
+    # อีก replica ต้องหลบ key ที่เพิ่งหมดโควต้าทุกครั้ง
+    for _ in range(4):
+        chosen = second.acquire()
+        assert chosen.index != key_state.index
+        second.release(chosen, 0.1)
+
+
+def test_response_store_round_trip(app, server):
+    redis_client = client(server)
+    store = app.RedisResponseStore(redis_client, 60)
+    store.save("key", "คำตอบ", 100.0)
+    assert store.load("key") == ("คำตอบ", 100.0)
+    assert store.contains("key") and not store.contains("missing")
+    assert 0 < redis_client.ttl(f"{app.REDIS_KEY_PREFIX}:response:key") <= 60
+    store.clear()
+    assert store.load("key") is None
+
+
+def test_response_cache_is_shared_between_replicas(app, server):
+    first = app.ResponseCache(60, 10, app.RedisResponseStore(client(server), 60))
+    second = app.ResponseCache(60, 10, app.RedisResponseStore(client(server), 60))
+    first.set("key", "คำตอบ")
+    assert second.contains("key")
+    assert second.get("key") == "คำตอบ"
+    assert second.stats()["shared_hits"] == 1
+    # ครั้งถัดไปตอบจาก LRU ในเครื่องโดยไม่ถาม Redis
+    assert second.get("key") == "คำตอบ"
+    assert second.stats()["shared_hits"] == 1
+
+
+def test_response_store_degrades_when_redis_is_down(app, server):
+    store = app.RedisResponseStore(client(server), 60)
+    server.connected = False
+    store.save("key", "คำตอบ", 100.0)
+    assert store.load("key") is None
+    assert not store.contains("key")
+
+
+class QuotaErrorModel:
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        raise Exception("429 RESOURCE_EXHAUSTED")
+
+
+def test_key_pool_keeps_working_when_redis_is_down(app, server, monkeypatch):
+    server.connected = False
+    key_pool = app.KeyPool(["test-key-aaaa", "test-key-bbbb"], app.RedisStateStore(client(server)))
+    monkeypatch.setattr(app, "get_key_pool", lambda: key_pool)
+    key_pool.keys[0].model = QuotaErrorModel()
+    cache = app.ResponseCache(60, 10)
+    generation = ("search", "full")
+    chunks = list(app.stream_from_key_pool("prompt", cache, app.response_key("prompt", generation), generation))
+    # สลับไป key ที่สองได้ตามปกติ และช่วงพักของ key แรกยังถูกจำไว้ใน process นี้
+    assert not app.stream_failed(chunks) and "".join(chunks)
+    assert key_pool.stats()[0]["cooldown_s"] > 0
+    assert key_pool.acquire().index == 1
+
+
+def test_page_renders_when_redis_is_down(server, monkeypatch, tmp_path):
+    from tests.test_modes import SEARCH_MENUS, card_names, run_page
+
+    server.connected = False
+    # get_redis_client สร้าง FakeRedis เมื่อ REDIS_URL=fakeredis:// ให้ชี้ไปที่ server ที่ปิดไว้
+    monkeypatch.setattr(fakeredis, "FakeRedis", functools.partial(fakeredis.FakeRedis, server=server))
+    try:
+        at = run_page(monkeypatch, tmp_path, False, STATE_BACKEND="redis",
+                      REDIS_URL="fakeredis://")
+        at.button(key="search_menu").click().run()
+        assert not at.exception
+        assert card_names(at) == SEARCH_MENUS
+    finally:
+        st.cache_resource.clear()
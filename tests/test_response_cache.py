@@ -0,0 +1,98 @@
+# ResponseCache: LRU ในหน่วยความจำ, TTL ของทั้งสองชั้น และชั้น SQLite ที่หลาย instance (worker) ใช้ร่วมกัน
+import time
+
+import pytest
+
+PROMPT = "แนะนำเมนูอาหารไทย 3 เมนู"
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def store(app, tmp_path):
+    return app.SQLiteResponseStore(str(tmp_path / "response_cache.db"), 60, 100)
+
+
+def test_lru_evicts_least_recently_used(app):
+    cache = app.ResponseCache(60, 2)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"  # a ถูกใช้ล่าสุด b จึงเก่าที่สุด
+    cache.set("c", "C")
+    assert cache.stats()["entries"] == 2
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("A", None, "C")
+
+
+def test_memory_entries_expire(app, clock):
+    cache = app.ResponseCache(60, 10)
+    cache.set("a", "A")
+    clock.now += 59
+    assert cache.get("a") == "A" and cache.contains("a")
+    clock.now += 2
+    assert not cache.contains("a")
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_sqlite_entries_expire(app, clock, store):
+    cache = app.ResponseCache(60, 10, store)
+    cache.set("a", "A")
+    cache.entries.clear()  # บังคับให้อ่านจากชั้น SQLite
+    clock.now += 59
+    assert cache.get("a") == "A"
+    cache.entries.clear()
+    clock.now += 2
+    assert store.load("a") is None and not cache.contains("a")
+    assert cache.get("a") is None
+
+
+def test_key_ignores_whitespace_differences(app):
+    key = app.ResponseCache.make_key(PROMPT, app.MODEL_NAME)
+    assert app.ResponseCache.make_key("  แนะนำเมนูอาหารไทย\n\t3   เมนู ", app.MODEL_NAME) == key
+    assert app.ResponseCache.make_key("แนะนำเมนูอาหารจีน 3 เมนู", app.MODEL_NAME) != key
+    assert app.ResponseCache.make_key(PROMPT, app.MODEL_NAME, {"max_output_tokens": 512}) != key
+
+
+def test_bypass_skips_reads_and_writes(app, store):
+    cache = app.ResponseCache(60, 10, store)
+    cache.set("a", "A")
+    cache.bypass = True
+    assert cache.get("a") is None
+    cache.set("b", "B")
+    cache.bypass = False
+    assert cache.get("a") == "A"
+    assert cache.get("b") is None and store.load("b") is None
+
+
+def test_instances_share_the_sqlite_tier(app, store):
+    writer = app.ResponseCache(60, 10, store)
+    reader = app.ResponseCache(60, 10, app.SQLiteResponseStore(store.db_file, 60, 100))
+    key = app.ResponseCache.make_key(PROMPT, app.MODEL_NAME)
+    assert reader.get(key) is None
+    writer.set(key, "คำตอบ")
+    assert reader.contains(key)
+    assert reader.get(key) == "คำตอบ"
+    assert reader.get(key) == "คำตอบ"  # ครั้งที่สองตอบจากหน่วยความจำของ reader เอง
+    assert reader.stats() == {"entries": 1, "hits": 2, "shared_hits": 1, "misses": 1, "hit_rate": 2 / 3}
+
+
+def test_sqlite_tier_is_bounded(app, clock, store):
+    store.max_entries = 3
+    cache = app.ResponseCache(60, 10, store)
+    for i in range(5):
+        clock.now += 1
+        cache.set(str(i), str(i))
+    assert [store.load(str(i)) is not None for i in range(5)] == [False, False, True, True, True]
@@ -0,0 +1,73 @@
+# คำขอที่ prompt ตรงกันและมาพร้อมกันต้องใช้การเรียก backend ครั้งเดียวร่วมกัน
+import threading
+import time
+
+import pytest
+
+CONCURRENT_REQUESTS = 16
+GENERATION = ("search", "full")
+
+
+@pytest.fixture
+def backend(app, monkeypatch):
+    class CountingModel(app.SyntheticModel):
+        calls = 0
+        lock = threading.Lock()
+
+        def generate_content(self, prompt, stream=False, generation_config=None):
+            with CountingModel.lock:
+                CountingModel.calls += 1
+            # หน่วงให้คำขออื่นมาถึงระหว่างที่คำขอแรกยังไม่เสร็จ
+            time.sleep(0.3)
+            return super().generate_content(prompt, stream, generation_config)
+
+    key_pool = app.KeyPool(["test-key-aaaa", "test-key-bbbb"])
+    cache = app.ResponseCache(60, 100)
+    flights = app.SingleFlight()
+    workers = app.WorkerPool(app.MAX_UPSTREAM_CALLS, app.MAX_QUEUED_JOBS)
+    monkeypatch.setitem(app.MODEL_BACKENDS, app.MODEL_BACKEND, CountingModel)
+    monkeypatch.setattr(app, "get_key_pool", lambda: key_pool)
+    monkeypatch.setattr(app, "get_response_cache", lambda: cache)
+    monkeypatch.setattr(app, "get_single_flight", lambda: flights)
+    monkeypatch.setattr(app, "get_worker_pool", lambda: workers)
+    return CountingModel, flights
+
+
+def call_concurrently(app, prompts):
+    barrier = threading.Barrier(len(prompts))
+    results = [None] * len(prompts)
+
+    def request(i):
+        barrier.wait()
+        results[i] = app.call_gemini_api(prompts[i], GENERATION)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(len(prompts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return results
+
+
+def test_identical_requests_share_one_call(app, backend):
+    model, flights = backend
+    results = call_concurrently(app, ["ไข่เจียว"] * CONCURRENT_REQUESTS)
+    assert model.calls == 1
+    assert len(set(results)) == 1 and "เมนูทดสอบ 1" in results[0]
+    stats = flights.stats()
+    assert stats["leaders"] == 1 and stats["coalesced"] == CONCURRENT_REQUESTS - 1
+    assert stats["in_flight"] == 0
+
+
+def test_later_request_is_served_from_cache(app, backend):
+    model, _ = backend
+    call_concurrently(app, ["ไข่เจียว"] * 4)
+    assert app.call_gemini_api("ไข่เจียว", GENERATION)
+    assert model.calls == 1
+
+
+def test_different_prompts_are_not_coalesced(app, backend):
+    model, flights = backend
+    call_concurrently(app, ["ไข่เจียว", "ต้มยำ", "ผัดกะเพรา"] * 4)
+    assert model.calls == 3
+    assert flights.stats()["coalesced"] == 9
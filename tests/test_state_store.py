@@ -0,0 +1,78 @@
+# ยิงตัวนับและ presence พร้อมกันจากหลาย thread (และหลาย process สำหรับ SQLite) แล้วตรวจว่าไม่มีค่าหาย
+import multiprocessing
+import threading
+import time
+
+from tests.app_loader import load_app
+
+THREADS = 16
+PROCESSES = 4
+ITERATIONS = 200
+SESSIONS_PER_WORKER = 5
+
+
+def hammer(store, worker, iterations):
+    for i in range(iterations):
+        store.increment("visitors")
+        store.touch(f"session-{worker}-{i % SESSIONS_PER_WORKER}", time.time())
+        store.count_active(time.time() - 60)
+
+
+def hammer_threads(store, first_worker, threads):
+    workers = [threading.Thread(target=hammer, args=(store, first_worker + n, ITERATIONS)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def hammer_process(db_file, first_worker, threads):
+    app = load_app()
+    hammer_threads(app.SQLiteStateStore(db_file), first_worker, threads)
+
+
+def assert_consistent(store, start, workers):
+    assert store.get("visitors") == start + workers * ITERATIONS
+    assert store.count_active(time.time() - 60) == workers * SESSIONS_PER_WORKER
+    assert len(store.sessions()) == workers * SESSIONS_PER_WORKER
+
+
+def test_memory_store_threads(app):
+    store = app.MemoryStateStore()
+    start = store.get("visitors")
+    hammer_threads(store, 0, THREADS)
+    assert_consistent(store, start, THREADS)
+
+
+def test_sqlite_store_threads(app, tmp_path):
+    store = app.SQLiteStateStore(str(tmp_path / "presence.db"))
+    start = store.get("visitors")
+    hammer_threads(store, 0, THREADS)
+    assert_consistent(store, start, THREADS)
+
+
+def test_sqlite_store_processes(app, tmp_path):
+    db_file = str(tmp_path / "presence.db")
+    store = app.SQLiteStateStore(db_file)
+    start = store.get("visitors")
+    threads_per_process = THREADS // PROCESSES
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=hammer_process, args=(db_file, n * threads_per_process, threads_per_process))
+                 for n in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(120)
+    assert [process.exitcode for process in processes] == [0] * PROCESSES
+    assert_consistent(store, start, THREADS)
+
+
+def test_memory_store_reset_and_key_quotas(app):
+    store = app.MemoryStateStore()
+    store.increment("visitors")
+    store.touch("session", time.time())
+    store.set_key_quota("key", 123.0, 2)
+    store.reset()
+    assert store.get("visitors") == 0
+    assert store.sessions() == []
+    assert store.key_quotas() == {"key": (123.0, 2)}
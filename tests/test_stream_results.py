@@ -0,0 +1,79 @@
+# ผลสำเร็จ/ล้มเหลวของสตรีมต้องมาจากชนิดของ chunk แม้ข้อผิดพลาดจะมาหลังคำตอบบางส่วนแล้ว
+import pytest
+
+GENERATION = ("create", "full")
+
+
+class FailingModel:
+    # ส่งคำตอบไปครึ่งหนึ่งแล้วล้มกลางสตรีม เหมือน API ตัดการเชื่อมต่อ
+    def __init__(self, api_key):
+        pass
+
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        yield from [type("Chunk", (), {"text": '{"name": "ไข่เจียว"}\n'})()]
+        raise Exception("500 Internal error")
+
+
+@pytest.fixture
+def failing_pool(app, monkeypatch):
+    monkeypatch.setitem(app.MODEL_BACKENDS, app.MODEL_BACKEND, FailingModel)
+    key_pool = app.KeyPool(["test-key-aaaa"])
+    monkeypatch.setattr(app, "get_key_pool", lambda: key_pool)
+    return key_pool
+
+
+def remembered(app, chunks):
+    completed = []
+    received = list(app.remember_response(iter(chunks), completed.append))
+    return received, completed
+
+
+def test_successful_stream_is_remembered(app):
+    received, completed = remembered(app, ['{"name": "ไข่เจียว"}\n', '{"name": "ไข่ตุ๋น"}\n'])
+    assert completed == ["".join(received).strip()]
+
+
+@pytest.mark.parametrize("error", ["❌ เกิดข้อผิดพลาด: 500", "🚦 busy"])
+def test_failed_stream_is_not_remembered(app, error):
+    _, completed = remembered(app, ['{"name": "ไข่เจียว"}\n', app.StreamError(error)])
+    assert completed == []
+
+
+def test_error_text_from_the_model_is_still_an_answer(app):
+    # ข้อความที่โมเดลตอบเองไม่ใช่ข้อผิดพลาดของระบบ แม้จะขึ้นต้นด้วย emoji เดียวกัน
+    _, completed = remembered(app, ["⚠️ ควรระวังการแพ้อาหาร\n", '{"name": "ไข่เจียว"}\n'])
+    assert len(completed) == 1
+
+
+def test_mid_stream_failure_is_marked_and_not_cached(app, failing_pool):
+    cache = app.ResponseCache(60, 10)
+    cache_key = app.response_key("prompt", GENERATION)
+    chunks = list(app.stream_from_key_pool("prompt", cache, cache_key, GENERATION))
+    assert chunks[0] == '{"name": "ไข่เจียว"}\n'
+    assert isinstance(chunks[-1], app.StreamError) and app.stream_failed(chunks)
+    assert cache.get(cache_key) is None
+
+
+@pytest.fixture
+def catalog(app, monkeypatch, tmp_path):
+    menu_catalog = app.MenuCatalog(str(tmp_path / "catalog.db"))
+    cache = app.ResponseCache(60, 10)
+    monkeypatch.setattr(app, "get_menu_catalog", lambda: menu_catalog)
+    monkeypatch.setattr(app, "get_response_cache", lambda: cache)
+    return menu_catalog
+
+
+COMBO = ("ประเทศไทย", "อาหารคาว", "เผ็ด", "50 - 100 บาท")
+
+
+def test_catalog_refresh_stores_completed_answer(app, catalog, monkeypatch):
+    key_pool = app.KeyPool(["test-key-aaaa"])
+    monkeypatch.setattr(app, "get_key_pool", lambda: key_pool)
+    assert app.refresh_catalog_entry(COMBO)
+    menus, is_stale = catalog.get(COMBO)
+    assert len(menus) == 3 and not is_stale
+
+
+def test_catalog_refresh_skips_failed_answer(app, catalog, failing_pool):
+    assert not app.refresh_catalog_entry(COMBO)
+    assert catalog.get(COMBO) is None
@@ -0,0 +1,69 @@
+# คำตอบที่ถูกตัดที่ max_output_tokens ต้องไม่ถูกเก็บเป็นคำตอบสำเร็จ
+import pytest
+from google.genai import types as genai_types
+
+GENERATION = ("search", "summary")
+
+
+@pytest.fixture
+def pool(app, monkeypatch):
+    key_pool = app.KeyPool(["test-key-aaaa"])
+    monkeypatch.setattr(app, "get_key_pool", lambda: key_pool)
+    return key_pool
+
+
+def stream(app, generation=GENERATION):
+    cache = app.ResponseCache(60, 10)
+    cache_key = app.response_key("prompt", generation)
+    return list(app.stream_from_key_pool("prompt", cache, cache_key, generation)), cache.get(cache_key)
+
+
+def test_finish_reason_from_sdk_chunk(app):
+    chunk = genai_types.GenerateContentResponse(
+        candidates=[genai_types.Candidate(finish_reason=genai_types.FinishReason.MAX_TOKENS)])
+    assert app.finish_reason(chunk) == "MAX_TOKENS"
+    assert app.finish_reason(genai_types.GenerateContentResponse()) is None
+    assert app.finish_reason(app.FakeChunk("text", finish_reason="STOP")) == "STOP"
+
+
+def test_truncated_answer_is_not_cached(app, pool, monkeypatch):
+    monkeypatch.setitem(app.GENERATION_CONFIGS, GENERATION, {"max_output_tokens": 40})
+    before = app.counter_totals("gemini_calls", "outcome").get("truncated", 0)
+    chunks, cached = stream(app)
+    assert cached is None
+    assert isinstance(chunks[-1], app.StreamError) and chunks[-1].startswith("✂️")
+    assert app.counter_totals("gemini_calls", "outcome")["truncated"] == before + 1
+    # key ไม่ได้ผิดปกติ จึงไม่ถูกนับเป็น error หรือถูกพัก
+    stats = pool.stats()[0]
+    assert stats["errors"] == 0 and stats["quota_errors"] == 0 and stats["cooldown_s"] == 0
+
+
+def test_answer_within_cap_is_cached(app, pool):
+    chunks, cached = stream(app)
+    assert not app.stream_failed(chunks)
+    assert cached == "".join(chunks).strip()
+
+
+def test_tiered_generation_is_off_by_default(app):
+    assert not app.TIERED_GENERATION and app.GENERATION_TIER == "full"
+
+
+class PromptUsageThenFailure:
+    # google.genai ส่ง usage_metadata ที่มีแค่ prompt_token_count มาใน chunk แรกๆ แล้วสตรีมล้มก่อนถึง chunk สุดท้าย
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        yield genai_types.GenerateContentResponse(
+            candidates=[genai_types.Candidate(content=genai_types.Content(
+                role="model", parts=[genai_types.Part(text='{"name": "ไข่เจียว"}\n')]))],
+            usage_metadata=genai_types.GenerateContentResponseUsageMetadata(prompt_token_count=12))
+        raise Exception("500 INTERNAL")
+
+
+def test_partial_usage_does_not_mask_the_stream_error(app, pool):
+    pool.keys[0].model = PromptUsageThenFailure()
+    before = app.counter_totals("gemini_tokens", "kind")
+    chunks, cached = stream(app, ("search", "full"))
+    assert cached is None
+    assert isinstance(chunks[-1], app.StreamError) and chunks[-1] == "❌ เกิดข้อผิดพลาด: 500 INTERNAL"
+    after = app.counter_totals("gemini_tokens", "kind")
+    assert after["prompt"] == before.get("prompt", 0) + 12
+    assert after.get("output", 0) == before.get("output", 0)